@@ -0,0 +1,135 @@
+import os
+import copy
+import glob
+import json
+import hashlib
+import time
+import multiprocessing
+
+EXTENSIONS = ('npy', 'npz', 'ply', 'txt', 'pth')
+LIST_EXTENSIONS = ('lst', 'list')
+# options that change the rendered image, a finished item is rendered again when one of them changes
+SETTINGS = ('tool', 'white', 'RGB', 'knn', 'center_num', 'fps_subset', 'part', 'variant', 'rot', 'num', 'sampler',
+            'res', 'radius', 'contrast', 'separator', 'type', 'mask', 'mask_center', 'mask_ratio', 'mask_radius',
+            'view', 'views', 'turntable', 'contact_sheet', 'translate', 'scale', 'median', 'voxel_size', 'spp',
+            'progressive', 'time_budget', 'tolerance', 'cull', 'cull_margin')
+
+
+def collect_inputs(path):
+    """Input files of a batch: a directory, a glob pattern or a list file with one path per line.
+
+    Returns None when path is a single point cloud file.
+    """
+    if os.path.isdir(path):
+        files = [os.path.join(root, f) for root, _, names in os.walk(path) for f in names]
+        return sorted(f for f in files if f.split('.')[-1] in EXTENSIONS)
+    if glob.has_magic(path):
+        return sorted(f for f in glob.glob(path, recursive=True) if os.path.isfile(f))
+    if path.split('.')[-1] in LIST_EXTENSIONS:
+        base = os.path.dirname(path)
+        with open(path, 'r') as f:
+            lines = [line.strip() for line in f]
+        return [os.path.join(base, line) for line in lines if line and not line.startswith('#')]
+    return None
+
+
+def output_names(config, paths):
+    # flatten the path relative to the common input directory so equal file names do not collide, inputs
+    # that still share a name (a.npy and a.txt) keep their extension, then get a numeric suffix
+    extension = config.output.split('.')[-1]
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+    names, used = [], set()
+    for p in paths:
+        relative = os.path.relpath(os.path.abspath(p), root).replace(os.sep, '_')
+        stem = relative.rsplit('.', 1)[0]
+        if stem in used:
+            stem = relative.replace('.', '_')
+        unique, i = stem, 1
+        while unique in used:
+            unique, i = f'{stem}_{i}', i + 1
+        used.add(unique)
+        names.append(os.path.join(config.outdir, unique + '.' + extension))
+    return names
+
+
+def load_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_file, manifest):
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def settings_key(config):
+    # hash of the SETTINGS of config, the number lists of the command line (strings) and of the defaults alike
+    settings = {}
+    for name in SETTINGS:
+        value = getattr(config, name, None)
+        if isinstance(value, list):
+            try:
+                value = [float(v) for v in value]
+            except ValueError:
+                pass
+        settings[name] = value
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def is_done(config, entry, path, output):
+    # --part, --views and --turntable write numbered <output>_<i> files instead of output itself
+    numbered = config.part or config.turntable > 0 or len(config.views) > 0
+    return entry is not None and entry['status'] == 'done' and entry['output'] == output and \
+        entry.get('settings') == settings_key(config) and entry['mtime'] == os.path.getmtime(path) and \
+        (numbered or os.path.exists(output))
+
+
+def run_item(task):
+    run, config = task
+    start = time.perf_counter()
+    try:
+        run(config)
+        status, error = 'done', None
+    except Exception as e:
+        status, error = 'failed', f'{type(e).__name__}: {e}'
+    return config.path, config.output, status, error, time.perf_counter() - start
+
+
+def render_batch(config, paths, run):
+    """Render every path with run(config) on a pool of --jobs worker processes.
+
+    Finished items are recorded in <outdir>/manifest.json and skipped when the batch is run again.
+    """
+    os.makedirs(config.outdir, exist_ok=True)
+    manifest_file = os.path.join(config.outdir, 'manifest.json')
+    manifest = load_manifest(manifest_file)
+    settings = settings_key(config)
+
+    tasks = []
+    for path, output in zip(paths, output_names(config, paths)):
+        if is_done(config, manifest.get(path), path, output):
+            continue
+        item_config = copy.copy(config)
+        item_config.path, item_config.output = path, output
+        # pool workers can not start a nested pool for --part, and share the cores between them for rendering
+        item_config.threads = config.threads or max(1, os.cpu_count() // max(1, config.jobs))
+        item_config.jobs = 1
+        tasks.append((run, item_config))
+    print(f'batch: {len(paths)} inputs, {len(paths) - len(tasks)} already done, {len(tasks)} to render')
+
+    if not tasks:
+        return
+    start = time.perf_counter()
+    failed = 0
+    with multiprocessing.get_context('spawn').Pool(max(1, config.jobs)) as pool:
+        for path, output, status, error, seconds in pool.imap_unordered(run_item, tasks):
+            manifest[path] = {'output': output, 'status': status, 'error': error, 'seconds': round(seconds, 3),
+                              'mtime': os.path.getmtime(path) if os.path.exists(path) else None,
+                              'settings': settings}
+            save_manifest(manifest_file, manifest)
+            failed += status != 'done'
+            print(f'batch: [{status}] {path} -> {output} in {seconds:.2f}s' + (f' ({error})' if error else ''))
+    print(f'batch: rendered {len(tasks) - failed} items, {failed} failed, in {time.perf_counter() - start:.2f}s')
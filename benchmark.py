@@ -0,0 +1,730 @@
+import os
+import json
+import sys
+import platform
+import argparse
+import tempfile
+import time
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import mitsuba as mi
+from plyfile import PlyData, PlyElement
+from scipy.ndimage import median_filter
+from scipy.spatial import distance
+from skimage.measure import marching_cubes
+from scipy.spatial import cKDTree
+from utils import color_map, fps, load, mask_point, median_filter_3d, downsample, standardize_bbox, rotation, \
+    get_scene_dict
+from simple3d import rasterize, view_rotation, fit_points
+from pointcloud import PointCloud
+from client import render_remote, server_status
+from render import compose_grid, render_tiled, cull_hidden
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Point Cloud Visualizer Benchmark')
+    parser.add_argument('bench', type=str, help='benchmark to run', choices=sorted(BENCHMARKS))
+    parser.add_argument('--sizes', nargs='+', type=int, help='point counts', default=[10000, 100000, 1000000])
+    parser.add_argument('--center_num', type=int, help='KNN center num', default=24)
+    parser.add_argument('--k', type=int, help='fps sample num', default=1024)
+    parser.add_argument('--fps_subset', type=int, help='subset size of the approximate fps', default=65536)
+    parser.add_argument('--lines', type=int, help='line count of the txt file used by the load benchmark', default=5000000)
+    parser.add_argument('--voxel_sizes', nargs='+', type=int, help='median filter grid resolutions', default=[64, 256, 512])
+    parser.add_argument('--num', type=int, help='downsampled point count of the sampler benchmark', default=10000)
+    parser.add_argument('--image_size', type=int, help='rasterizer image size', default=256)
+    parser.add_argument('--views', type=int, help='rasterizer views per batch', default=16)
+    parser.add_argument('--repeat', type=int, help='keep the best of repeated runs', default=1)
+    parser.add_argument('--legacy_max', type=int, help='skip the per-point legacy code above this size', default=1000000)
+    parser.add_argument('--shapes', nargs='+', help='synthetic clouds of the stages benchmark',
+                        choices=SHAPES, default=list(SHAPES))
+    parser.add_argument('--txt_max', type=int, help='skip writing and loading txt files above this size', default=1000000)
+    parser.add_argument('--render_max', type=int, help='the scene and render stages use at most this many points', default=10000)
+    parser.add_argument('--spp', type=int, help='samples per pixel of the render stage', default=4)
+    parser.add_argument('--variants', nargs='+', help='mitsuba variants of the variant benchmark',
+                        default=['scalar_rgb', 'llvm_ad_rgb'])
+    parser.add_argument('--threads', nargs='+', type=int, help='render thread counts of the variant benchmark, 0 for all cores',
+                        default=[1, 0])
+    parser.add_argument('--tile', type=int, help='tile size of the tile benchmark', default=64)
+    parser.add_argument('--items', type=int, help='clouds composed into one scene by the grid benchmark', default=16)
+    parser.add_argument('--requests', type=int, help='requests sent to the render server per size', default=32)
+    parser.add_argument('--clients', type=int, help='client threads sending the requests to the render server', default=4)
+    parser.add_argument('--jobs', type=int, help='worker processes of the render server', default=1)
+    parser.add_argument('--max_import_ms', type=float, help='startup fails above this import time of main.py, 0 for no limit', default=0)
+    parser.add_argument('--json', type=str, help='write the results to this file, or the results read by compare', default=None)
+    parser.add_argument('--baseline', type=str, help='baseline results of compare', default=None)
+    parser.add_argument('--threshold', type=float, help='compare flags stages slower than baseline by this fraction', default=0.2)
+    parser.add_argument('--min_time', type=float, help='compare ignores stages faster than this many ms in both runs', default=1.0)
+    return parser.parse_args()
+
+
+SHAPES = ('sphere', 'plane', 'noisy', 'colored', 'batched')
+RESULTS = []
+
+
+def synthetic_cloud(n, seed=0, shape='sphere'):
+    """Synthetic float32 cloud inside the [-0.5, 0.5] box, like standardize_bbox output.
+
+    sphere: points on a sphere. plane: a flat square. noisy: the sphere with gaussian noise and 5% uniform
+    outliers. colored: the sphere with N x 3 rgb in [0, 1]. batched: 4 x N x 3 spheres. solid: points filling the
+    ball (not in SHAPES).
+    """
+    rng = np.random.default_rng(seed)
+    if shape == 'batched':
+        return np.stack([synthetic_cloud(n, seed + b) for b in range(4)])
+    if shape == 'plane':
+        pcl = np.concatenate((rng.random((n, 2)) - 0.5, np.zeros((n, 1))), axis=1)
+        return pcl.astype(np.float32)
+    pcl = rng.normal(size=(n, 3))
+    pcl /= np.linalg.norm(pcl, axis=1, keepdims=True) * 2
+    if shape == 'noisy':
+        pcl += rng.normal(scale=0.01, size=(n, 3))
+        outliers = rng.random(n) < 0.05
+        pcl[outliers] = rng.random((np.sum(outliers), 3)) - 0.5
+        pcl = np.clip(pcl, -0.5, 0.5)
+    if shape == 'solid':
+        pcl *= rng.random((n, 1)) ** (1 / 3)
+    if shape == 'colored':
+        pcl = np.concatenate((pcl, rng.random((n, 3))), axis=1)
+    return pcl.astype(np.float32)
+
+
+def timeit(func, repeat=1):
+    best, result = np.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def report(name, n, new, old=None):
+    RESULTS.append({'name': name, 'n': int(n), 'ms': new * 1000, 'legacy_ms': None if old is None else old * 1000})
+    line = f'{name:24s} n={n:>9d}  {new * 1000:10.1f} ms'
+    if old is not None:
+        line += f'  legacy {old * 1000:10.1f} ms  speedup {old / new:8.1f}x'
+    print(line)
+
+
+def stage_config(args, **overrides):
+    # the main.py options the pipeline stages read, at their defaults
+    config = argparse.Namespace(median=False, voxel_size=64, num=np.inf, sampler='random', fps_subset=0, white=False,
+                                RGB=[], knn=False, center_num=args.center_num, contrast=0.0004)
+    vars(config).update(overrides)
+    return config
+
+
+def legacy_color_map(config, pcl):
+    # per-point reference implementation the vectorized color_map has to match
+    n = pcl.shape[0]
+    color = np.zeros((n, 3))
+    if config.knn:
+        knn_center = fps(pcl + 0.5, config.center_num)
+        for i in range(n):
+            dis = np.linalg.norm(knn_center - (pcl[i] + 0.5), axis=1)
+            vec = np.clip(knn_center[np.argmin(dis)], config.contrast, 1.0)
+            color[i] = vec / np.sqrt(np.sum(vec ** 2))
+    else:
+        for i in range(n):
+            vec = np.clip(pcl[i] + 0.5, config.contrast, 1.0)
+            color[i] = vec / np.sqrt(np.sum(vec ** 2))
+    return np.concatenate((pcl[:, :3], color), axis=1)
+
+
+def bench_color_map(args):
+    for knn in (False, True):
+        config = argparse.Namespace(white=False, RGB=[], knn=knn, center_num=args.center_num, contrast=0.0004,
+                                    fps_subset=0)
+        name = 'color_map knn' if knn else 'color_map pos'
+        for n in args.sizes:
+            pcl = synthetic_cloud(n)
+            new, result = timeit(lambda: color_map(config, PointCloud(pcl[:, :3].astype(np.float32))), args.repeat)
+            old = None
+            if n <= args.legacy_max:
+                old, expected = timeit(lambda: legacy_color_map(config, pcl))
+                # the colors are stored as float16
+                assert np.allclose(result.array(), expected, atol=1e-3), \
+                    f'{name} output differs from the legacy implementation'
+            report(name, n, new, old)
+
+
+def legacy_fps(data, k):
+    # the original shrinking-array fps, started from inf instead of nan
+    sample_data = np.zeros((k, data.shape[1]))
+    points = data[:, :3]
+    distance = np.full((points.shape[0]), np.inf)
+    point = np.sum(points, axis=0) / points.shape[0]
+    for i in range(k):
+        distance = np.minimum(distance, np.sum((points - point) ** 2, axis=1))
+        index = np.argmax(distance)
+        point = points[index]
+        sample_data[i, :3] = point
+        mask = np.ones((points.shape[0]), dtype=bool)
+        mask[index] = False
+        points = points[mask]
+        distance = distance[mask]
+    return sample_data
+
+
+def bench_fps(args):
+    for n in args.sizes:
+        pcl = synthetic_cloud(n)
+        new, result = timeit(lambda: fps(pcl, args.k), args.repeat)
+        old = None
+        if n <= args.legacy_max:
+            old, expected = timeit(lambda: legacy_fps(pcl, args.k))
+            assert np.array_equal(result, expected), 'fps output differs from the legacy implementation'
+        report(f'fps k={args.k}', n, new, old)
+        if args.fps_subset < n:
+            approx, _ = timeit(lambda: fps(pcl, args.k, args.fps_subset), args.repeat)
+            report(f'fps k={args.k} subset={args.fps_subset}', n, approx, old)
+
+
+def legacy_load_txt(path, separator=','):
+    f = open(path, 'r')
+    line = f.readline()
+    data = []
+    while line:
+        x, y, z = line.split(separator)[:3]
+        data.append([float(x), float(y), float(z)])
+        line = f.readline()
+    f.close()
+    return np.array(data)
+
+
+def legacy_load_ply(path):
+    vertex = PlyData.read(path)['vertex']
+    (x, y, z) = (vertex[t] for t in ('x', 'y', 'z'))
+    return np.column_stack((x, y, z))
+
+
+def bench_load(args):
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as workdir:
+        pcl = rng.random((args.lines, 6))
+        path = os.path.join(workdir, 'cloud.txt')
+        np.savetxt(path, pcl, delimiter=',', fmt='%.6f')
+        new, result = timeit(lambda: load(path), args.repeat)
+        old, expected = timeit(lambda: legacy_load_txt(path))
+        assert np.array_equal(result.xyz, expected.astype(np.float32))
+        report('load txt', args.lines, new, old)
+
+        batch = rng.random((16, args.lines // 16, 6))
+        path = os.path.join(workdir, 'batch.npy')
+        np.save(path, batch)
+        new, _ = timeit(lambda: load(path), args.repeat)
+        old, _ = timeit(lambda: np.load(path, allow_pickle=True)[0])
+        report('load npy batch[0]', batch.shape[1], new, old)
+
+        path = os.path.join(workdir, 'batch.npz')
+        np.savez(path, pred=batch)
+        new, _ = timeit(lambda: load(path), args.repeat)
+        old, _ = timeit(lambda: np.load(path)['pred'][0])
+        report('load npz batch[0]', batch.shape[1], new, old)
+
+        vertex = np.empty(args.lines, dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4'),
+                                             ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+        for name in ('x', 'y', 'z'):
+            vertex[name] = rng.random(args.lines)
+        for name in ('red', 'green', 'blue'):
+            vertex[name] = rng.integers(0, 256, args.lines)
+        path = os.path.join(workdir, 'cloud.ply')
+        PlyData([PlyElement.describe(vertex, 'vertex')]).write(path)
+        new, result = timeit(lambda: load(path), args.repeat)
+        old, _ = timeit(lambda: legacy_load_ply(path))
+        assert len(result) == args.lines and result.channels == 6
+        report('load binary ply + rgb', args.lines, new, old)
+
+
+def legacy_mask_point(pcl, mask_center=128, mask_ratio=0.5):
+    # the original per-point cdist loop, with the center count slicing fixed so it runs
+    mask_center = fps(pcl[:, :3], mask_center)
+    mask_center = mask_center[:int(len(mask_center) * mask_ratio)]
+    new_pcl = []
+    for i in range(pcl.shape[0]):
+        distances = distance.cdist(pcl[i:i + 1, :3], mask_center, 'euclidean')
+        if np.min(distances) > 0.05:
+            new_pcl.append(pcl[i])
+    return np.array(new_pcl)
+
+
+def bench_mask(args):
+    for n in args.sizes:
+        pcl = synthetic_cloud(n)
+        new, result = timeit(lambda: mask_point(pcl), args.repeat)
+        old = None
+        if n <= args.legacy_max:
+            old, expected = timeit(lambda: legacy_mask_point(pcl))
+            assert np.array_equal(result, expected), 'mask_point output differs from the legacy implementation'
+        report('mask_point', n, new, old)
+
+
+def legacy_median_filter_3d(pcl, voxel_size=64, kernel_size=2, level=0.5):
+    R = voxel_size
+    voxel = np.zeros((R, R, R), dtype=np.int32)
+    point_cloud = pcl - np.min(pcl, axis=0)
+    point_cloud_scaled = point_cloud / np.max(np.max(point_cloud, axis=0)) * (R - 1)
+    for point in point_cloud_scaled:
+        voxel_index = np.floor(point).astype(int)
+        voxel[voxel_index[0], voxel_index[1], voxel_index[2]] = 1
+    voxel = median_filter(voxel, size=kernel_size)
+    pts, _, _, _ = marching_cubes(voxel, level=level)
+    return pts
+
+
+def bench_median(args):
+    for n in args.sizes:
+        pcl = synthetic_cloud(n)
+        for voxel_size in args.voxel_sizes:
+            new, result = timeit(lambda: median_filter_3d(pcl, voxel_size=voxel_size), args.repeat)
+            old = None
+            if n <= args.legacy_max and voxel_size <= 256:
+                old, expected = timeit(lambda: legacy_median_filter_3d(pcl, voxel_size))
+                assert len(result) == len(expected), 'median filter output differs from the legacy implementation'
+            report(f'median_filter_3d R={voxel_size}', n, new, old)
+
+
+def legacy_rasterize(xyz, c0, c1, c2, rotmat, showsz):
+    # body of the original showpoints render()
+    show = np.zeros((showsz, showsz, 3), dtype='uint8')
+    nxyz = xyz.dot(rotmat)
+    nz = nxyz[:, 1].argsort()
+    nxyz = nxyz[nz]
+    nxyz = (nxyz[:, :2] + [showsz / 2, showsz / 2]).astype('int32')
+    p = nxyz[:, 0] * showsz + nxyz[:, 1]
+    m = (nxyz[:, 0] >= 0) * (nxyz[:, 0] < showsz) * (nxyz[:, 1] >= 0) * (nxyz[:, 1] < showsz)
+    show.reshape((showsz * showsz, 3))[p[m], 1] = c0[nz][m]
+    show.reshape((showsz * showsz, 3))[p[m], 2] = c1[nz][m]
+    show.reshape((showsz * showsz, 3))[p[m], 0] = c2[nz][m]
+    return show
+
+
+def bench_raster(args):
+    size, views = args.image_size, args.views
+    angles = np.linspace(0, 2 * np.pi, views, endpoint=False)
+    rotmats = np.stack([view_rotation(0.3, a) for a in angles])
+    for n in args.sizes:
+        pcl = synthetic_cloud(n)
+        colors = ((pcl + 0.5) * 255).astype(np.uint8)
+        xyz = fit_points(pcl, size)
+        old, _ = timeit(lambda: [legacy_rasterize(xyz, colors[:, 1], colors[:, 2], colors[:, 0], r, size)
+                                 for r in rotmats], args.repeat)
+        for point_size in (1, 2):
+            single, _ = timeit(lambda: [rasterize(xyz, colors, r, size=size, point_size=point_size, fit=False)
+                                        for r in rotmats], args.repeat)
+            batch, _ = timeit(lambda: rasterize(xyz, colors, rotmats, size=size, point_size=point_size, fit=False),
+                              args.repeat)
+            print(f'rasterize {size}px point_size={point_size} n={n:>9d}  legacy {views / old:8.1f} fps  '
+                  f'single {views / single:8.1f} fps  batch of {views} {views / batch:8.1f} fps '
+                  f'({single / batch:.2f}x the per-view loop)')
+
+
+def bench_sampler(args):
+    # spacing statistics of the kept points: a larger minimum and a lower coefficient of variation of the
+    # nearest neighbor distance mean fewer clumps and holes
+    for n in args.sizes:
+        pcl = synthetic_cloud(n)
+        for sampler in ('random', 'voxel', 'poisson', 'fps'):
+            seconds, result = timeit(lambda: downsample(PointCloud.from_array(pcl), args.num, sampler,
+                                                        args.fps_subset), args.repeat)
+            spacing = cKDTree(result.xyz).query(result.xyz, k=2)[0][:, 1]
+            report(f'downsample {sampler}', n, seconds)
+            unique = len(np.unique(result.xyz, axis=0))
+            print(f'{"":24s} kept {len(result)} points ({unique} unique), nearest neighbor min {spacing.min():.4f} '
+                  f'mean {spacing.mean():.4f} cv {spacing.std() / spacing.mean():.3f}')
+
+
+def write_formats(workdir, pcl, txt_max):
+    # the cloud in every format load() supports, as (format, path)
+    files = []
+    path = os.path.join(workdir, 'cloud.npy')
+    np.save(path, pcl)
+    files.append(('npy', path))
+    path = os.path.join(workdir, 'cloud.npz')
+    np.savez(path, pred=pcl)
+    files.append(('npz', path))
+    if pcl.ndim == 2:
+        names = ['x', 'y', 'z', 'red', 'green', 'blue'][:pcl.shape[1]]
+        vertex = np.empty(len(pcl), dtype=[(name, 'f4' if i < 3 else 'u1') for i, name in enumerate(names)])
+        for i, name in enumerate(names):
+            vertex[name] = pcl[:, i] if i < 3 else pcl[:, i] * 255
+        path = os.path.join(workdir, 'cloud.ply')
+        PlyData([PlyElement.describe(vertex, 'vertex')]).write(path)
+        files.append(('ply', path))
+        if len(pcl) <= txt_max:
+            path = os.path.join(workdir, 'cloud.txt')
+            np.savetxt(path, pcl, delimiter=',', fmt='%.6f')
+            files.append(('txt', path))
+    try:
+        import torch
+        path = os.path.join(workdir, 'cloud.pth')
+        torch.save(torch.from_numpy(pcl), path)
+        files.append(('pth', path))
+    except ImportError:
+        pass
+    return files
+
+
+def bench_stages(args):
+    # every stage of main.py run on its own, on each synthetic shape and size
+    mi.set_variant('scalar_rgb')
+    for shape in args.shapes:
+        for n in args.sizes:
+            pcl = synthetic_cloud(n, shape=shape)
+            with tempfile.TemporaryDirectory() as workdir:
+                for extension, path in write_formats(workdir, pcl, args.txt_max):
+                    seconds, _ = timeit(lambda: load(path), args.repeat)
+                    report(f'{shape} load {extension}', n, seconds)
+            if shape == 'batched':
+                continue
+
+            config = stage_config(args)
+            seconds, cloud = timeit(lambda: standardize_bbox(config, PointCloud.from_array(pcl)), args.repeat)
+            report(f'{shape} standardize_bbox', n, seconds)
+            seconds, _ = timeit(lambda: np.matmul(cloud.xyz, rotation([30, 45, 60]).astype(np.float32)),
+                                args.repeat)
+            report(f'{shape} rotation', n, seconds)
+
+            seconds, _ = timeit(lambda: color_map(config, cloud.copy()), args.repeat)
+            report(f'{shape} color_map {"rgb" if cloud.channels == 6 else "pos"}', n, seconds)
+            seconds, colored = timeit(lambda: color_map(stage_config(args, knn=True), PointCloud(cloud.xyz.copy())),
+                                      args.repeat)
+            report(f'{shape} color_map knn', n, seconds)
+            value = PointCloud(cloud.xyz.copy(), np.linalg.norm(cloud.xyz, axis=1, keepdims=True))
+            seconds, _ = timeit(lambda: color_map(config, value.copy()), args.repeat)
+            report(f'{shape} color_map 1-d', n, seconds)
+            pcl = cloud.array()
+
+            k = min(args.k, n)
+            seconds, _ = timeit(lambda: fps(pcl, k, args.fps_subset), args.repeat)
+            report(f'{shape} fps k={k}', n, seconds)
+            seconds, _ = timeit(lambda: mask_point(pcl, fps_subset=args.fps_subset), args.repeat)
+            report(f'{shape} mask_point', n, seconds)
+            seconds, _ = timeit(lambda: median_filter_3d(pcl[:, :3], voxel_size=args.voxel_sizes[0]), args.repeat)
+            report(f'{shape} median R={args.voxel_sizes[0]}', n, seconds)
+
+            scene_pcl = colored.take(slice(args.render_max)).array()
+            for object_type in ('point', 'mesh'):
+                seconds, scene = timeit(lambda: mi.load_dict(get_scene_dict(
+                    scene_pcl, [args.image_size] * 2, [2.75, 2.75, 2.75], 0.025, object_type, args.spp)), args.repeat)
+                report(f'{shape} scene {object_type}', len(scene_pcl), seconds)
+                seconds, _ = timeit(lambda: mi.render(scene, spp=args.spp), args.repeat)
+                report(f'{shape} render {object_type} spp={args.spp}', len(scene_pcl), seconds)
+
+
+def variant_throughput(variant, threads, sizes, image_size, spp, repeat):
+    # runs in a fresh process per variant, the variant of a process can not be changed back and forth freely
+    import drjit as dr
+    mi.set_variant(variant)
+    if threads > 0:
+        dr.set_thread_count(threads)
+    results = []
+    for n in sizes:
+        pcl = color_map(stage_config(argparse.Namespace(center_num=24)), PointCloud.from_array(synthetic_cloud(n))).array()
+        for object_type in ('point', 'mesh'):
+            scene_seconds, scene = timeit(lambda: mi.load_dict(get_scene_dict(
+                pcl, [image_size] * 2, [2.75, 2.75, 2.75], 0.025, object_type, spp)), repeat)
+            mi.render(scene, spp=spp)  # the llvm variants compile their kernels on the first render
+            render_seconds, _ = timeit(lambda: np.array(mi.render(scene, spp=spp)), repeat)
+            results.append((object_type, n, scene_seconds, render_seconds))
+    return dr.thread_count(), results
+
+
+def bench_variant(args):
+    """Scene construction and render time of each --variants at each --threads, one child process per run.
+
+    A variant that can not render here (e.g. a broken LLVM install aborting the process) is reported as failed.
+    """
+    for variant in args.variants:
+        for threads in args.threads:
+            try:
+                with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                    used, results = pool.submit(variant_throughput, variant, threads, args.sizes, args.image_size,
+                                                args.spp, args.repeat).result()
+            except (BrokenProcessPool, ImportError, ValueError) as e:
+                print(f'{variant} threads={threads}: failed ({type(e).__name__}: {e})')
+                continue
+            for object_type, n, scene_seconds, render_seconds in results:
+                report(f'{variant} t={used} scene {object_type}', n, scene_seconds)
+                report(f'{variant} t={used} render {object_type}', n, render_seconds)
+                print(f'{"":24s} {args.image_size ** 2 * args.spp / render_seconds / 1e6:.2f} Msamples/s')
+
+
+def legacy_voxel_scene(pcl, resolution, radius, spp):
+    # the original --type voxel: one cube shape per point
+    scene = get_scene_dict(pcl[:0], resolution, [2.75, 2.75, 2.75], radius, 'point', spp)
+    for i in range(pcl.shape[0]):
+        x, y, z, r, g, b = pcl[i, :6].tolist()
+        scene[f'point_{i}'] = {'type': 'cube', 'to_world': mi.ScalarTransform4f().translate([x, y, z]).scale(radius),
+                               'bsdf': {'type': 'diffuse', 'reflectance': {'type': 'rgb', 'value': [r, g, b]}}}
+    return scene
+
+
+def bench_voxel(args):
+    mi.set_variant('scalar_rgb')
+    resolution, radius = [args.image_size] * 2, 0.0125
+    for n in args.sizes:
+        pcl = color_map(stage_config(args), PointCloud.from_array(synthetic_cloud(n))).array()
+        new, scene = timeit(lambda: mi.load_dict(get_scene_dict(pcl, resolution, [2.75, 2.75, 2.75], radius, 'voxel',
+                                                                 args.spp)), args.repeat)
+        render, _ = timeit(lambda: mi.render(scene, spp=args.spp), args.repeat)
+        old = old_render = None
+        if n <= args.render_max:
+            old, scene = timeit(lambda: mi.load_dict(legacy_voxel_scene(pcl, resolution, radius, args.spp)))
+            old_render, _ = timeit(lambda: mi.render(scene, spp=args.spp))
+        report('voxel scene', n, new, old)
+        report(f'voxel render spp={args.spp}', n, render, old_render)
+
+
+def bench_grid(args):
+    """One scene of --items clouds side by side against one scene and render per cloud, at the same resolution.
+
+    Both run in this process, separate main.py runs would also pay the interpreter start and the imports.
+    """
+    mi.set_variant('scalar_rgb')
+    config = argparse.Namespace(mask=False, scale=[1, 1, 1], translate=[0, 0, 0], grid_cols=0, grid_spacing=1.2,
+                                view=[2.75, 2.75, 2.75], res=[args.image_size] * 2)
+    for n in args.sizes:
+        clouds = [color_map(stage_config(args), PointCloud.from_array(synthetic_cloud(n, seed=i)))
+                  for i in range(args.items)]
+
+        def composed():
+            scene_pcl, _, view = compose_grid(config, clouds)
+            scene = mi.load_dict(get_scene_dict(scene_pcl, config.res, view, 0.025, 'mesh', args.spp))
+            return np.array(mi.render(scene))
+
+        def separate():
+            for pcl in clouds:
+                scene_pcl, _, view = compose_grid(config, [pcl])
+                scene = mi.load_dict(get_scene_dict(scene_pcl, config.res, view, 0.025, 'mesh', args.spp))
+                np.array(mi.render(scene))
+
+        new, _ = timeit(composed, args.repeat)
+        old, _ = timeit(separate, args.repeat)
+        report(f'grid of {args.items} spp={args.spp}', n, new, old)
+
+
+def srgb(image):
+    # the 8-bit sRGB values written to png and jpg files, in [0, 1]
+    return np.array(mi.Bitmap(image).convert(mi.Bitmap.PixelFormat.RGB, mi.Struct.Type.UInt8, True)) / 255
+
+
+def bench_tile(args):
+    """Tiled render on --jobs processes against a single pass, and the difference of the stitched image to the
+    single pass next to the difference of two single passes with other seeds (the noise floor).
+    """
+    mi.set_variant('scalar_rgb')
+    resolution = [args.image_size] * 2
+    for n in args.sizes:
+        pcl = color_map(stage_config(args), PointCloud.from_array(synthetic_cloud(n))).array()
+        pcl[:, 2] += 0.25
+        with tempfile.TemporaryDirectory() as workdir:
+            config = argparse.Namespace(res=resolution, spp=args.spp, view=[2.75, 2.75, 2.75], radius=0.025,
+                                        type='mesh', xml=False, workdir=workdir, tile=args.tile, jobs=args.jobs,
+                                        threads=0, variant='scalar_rgb', translate=[0, 0, 0], scale=[1, 1, 1],
+                                        profile=None, profile_memory=False, cull=False)
+            scene = mi.load_dict(get_scene_dict(pcl, resolution, config.view, config.radius, 'mesh', args.spp))
+            old, single = timeit(lambda: np.array(mi.render(scene, spp=args.spp, seed=0)))
+            other = np.array(mi.render(scene, spp=args.spp, seed=1))
+            new, _ = timeit(lambda: render_tiled(config, pcl, 'tile', config.view, os.path.join(workdir, 'tiled.png')))
+            tiled = np.array(mi.Bitmap(os.path.join(workdir, 'tiled.png'))) / 255
+        report(f'tile {args.tile} j={args.jobs}', n, new, old)
+        print(f'{"":24s} mean abs difference to a single pass {np.abs(tiled - srgb(single)).mean():.4f}, '
+              f'between two single passes {np.abs(srgb(other) - srgb(single)).mean():.4f}')
+
+
+def bench_cull(args):
+    # visibility culling from the default view, then the point scene of the kept points against the full scene
+    mi.set_variant('scalar_rgb')
+    config = argparse.Namespace(cull_margin=2, radius=0.025)
+    for shape in ('sphere', 'noisy', 'solid'):
+        for n in args.sizes:
+            pcl = color_map(stage_config(args), PointCloud.from_array(synthetic_cloud(n, shape=shape))).array()
+            pcl[:, 2] += 0.25
+            cull, kept = timeit(lambda: cull_hidden(config, pcl, [[2.75, 2.75, 2.75]]), args.repeat)
+            new, _ = timeit(lambda: mi.load_dict(get_scene_dict(kept, [args.image_size] * 2, [2.75, 2.75, 2.75],
+                                                                config.radius, 'point', args.spp)), args.repeat)
+            old, _ = timeit(lambda: mi.load_dict(get_scene_dict(pcl, [args.image_size] * 2, [2.75, 2.75, 2.75],
+                                                                config.radius, 'point', args.spp)), args.repeat)
+            report(f'cull + scene {shape}', n, cull + new, old)
+            print(f'{"":24s} kept {len(kept)} points ({len(kept) / n:.0%}), culling took {cull * 1000:.1f} ms')
+
+
+def bench_serve(args):
+    """Throughput of a main.py --serve server fed by --clients threads, against one main.py --render process
+    per cloud. Both use the first of --variants.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    variant = args.variants[0]
+    with tempfile.TemporaryDirectory() as workdir:
+        address = os.path.join(workdir, 'render.sock')
+        start = time.perf_counter()
+        server = subprocess.Popen([sys.executable, 'main.py', '--serve', '--address', address, '--jobs', str(args.jobs),
+                                   '--variant', variant, '--workdir', workdir], cwd=root, stdout=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(address):
+                assert server.poll() is None, 'the render server did not start'
+                time.sleep(0.1)
+            print(f'server ready in {time.perf_counter() - start:.2f}s: {server_status(address)}')
+            for n in args.sizes:
+                pcl = synthetic_cloud(n).astype(np.float32)
+                options = {'spp': args.spp, 'res': [args.image_size] * 2}
+                render_remote(pcl, address, **options)
+                start = time.perf_counter()
+                with ThreadPoolExecutor(args.clients) as pool:
+                    images = list(pool.map(lambda _: render_remote(pcl, address, **options), range(args.requests)))
+                new = (time.perf_counter() - start) / args.requests
+                assert all(len(image) > 0 for image in images)
+
+                path = os.path.join(workdir, 'cloud.npy')
+                np.save(path, pcl)
+                command = [sys.executable, 'main.py', '--render', '--path', path, '--variant', variant,
+                           '--workdir', workdir, '--output', os.path.join(workdir, 'cold.jpg'), '--spp', str(args.spp),
+                           '--res', str(args.image_size), str(args.image_size)]
+                old, _ = timeit(lambda: subprocess.run(command, cwd=root, stdout=subprocess.DEVNULL, check=True),
+                                args.repeat)
+                report(f'serve c={args.clients} j={args.jobs}', n, new, old)
+                print(f'{"":24s} {1 / new:.2f} requests/s, one process per render {1 / old:.2f} renders/s')
+        finally:
+            server.terminate()
+            server.wait()
+
+
+# heavy dependencies that only the stages using them may import, never main.py at startup
+LAZY_MODULES = ('mitsuba', 'drjit', 'matplotlib', 'cv2', 'scipy', 'skimage', 'plyfile', 'torch')
+
+
+def import_times(statement):
+    # cumulative import time in seconds of every module imported by statement, in a fresh interpreter
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        fields = line[len('import time:'):].split('|')
+        if line.startswith('import time:') and fields[1].strip().isdigit():
+            times[fields[2].rstrip()] = int(fields[1]) / 1e6
+    return times
+
+
+# a minimal render of the .npy file argv[1] through main.main(), the last line lists the LAZY_MODULES it imported
+RENDER_MODULES = '''
+import sys
+path, workdir, modules = sys.argv[1], sys.argv[2], sys.argv[3:]
+sys.argv = ['main.py', '--path', path, '--render', '--spp', '1', '--res', '32', '32', '--workdir', workdir,
+            '--output', workdir + '/render.png']
+import main
+main.main()
+print(' '.join(module for module in modules if module in sys.modules))
+'''
+
+
+def bench_startup(args):
+    """Import time of main.py from python -X importtime, best of --repeat fresh interpreters, against importing
+    everything main.py used to import eagerly.
+
+    Then renders a small .npy file at --spp 1 through main.main(), which must not load any of LAZY_MODULES but
+    mitsuba and drjit: the plain point render needs no scipy, cv2 or plyfile.
+
+    Returns 1 (the exit code) when main.py imports one of LAZY_MODULES, takes longer than --max_import_ms or
+    the render loads more than mitsuba and drjit.
+    """
+    eager = 'import main, render, server, simple3d, matplotlib.pyplot, mpl_toolkits.mplot3d'
+    new = old = np.inf
+    for _ in range(args.repeat):
+        times = import_times('import main')
+        # the top level entries are indented by one space, their cumulative times add up to the whole import
+        new = min(new, sum(t for name, t in times.items() if not name.startswith('  ')))
+        old = min(old, sum(t for name, t in import_times(eager).items() if not name.startswith('  ')))
+    report('startup import main', len(times), new, old)
+    # the modules main.py imports itself are indented by three
+    slowest = sorted((t, name.strip()) for name, t in times.items() if len(name) - len(name.lstrip()) == 3)[::-1]
+    print(f'{"":24s} slowest imports of main: ' + ', '.join(f'{name} {t * 1000:.0f} ms' for t, name in slowest[:5]))
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'main.py', '--help'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                   stdout=subprocess.DEVNULL, check=True)
+    print(f'{"":24s} python main.py --help: {(time.perf_counter() - start) * 1000:.0f} ms')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        np.save(os.path.join(workdir, 'cloud.npy'), synthetic_cloud(1000))
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', RENDER_MODULES, os.path.join(workdir, 'cloud.npy'), workdir,
+                                 *LAZY_MODULES], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True)
+    rendered = result.stdout.strip().splitlines()[-1].split() if result.stdout.strip() else []
+    print(f'{"":24s} .npy render at spp 1: {(time.perf_counter() - start) * 1000:.0f} ms, '
+          f'imported {", ".join(rendered) or "none of the lazy modules"}')
+
+    loaded = [module for module in LAZY_MODULES if module in {name.strip() for name in times}]
+    extra = [module for module in rendered if module not in ('mitsuba', 'drjit')]
+    if loaded:
+        print(f'FAIL: import main loads {", ".join(loaded)} at startup')
+    if extra:
+        print(f'FAIL: a plain .npy render loads {", ".join(extra)}')
+    if args.max_import_ms and new * 1000 > args.max_import_ms:
+        print(f'FAIL: import main takes {new * 1000:.0f} ms, more than --max_import_ms {args.max_import_ms:.0f} ms')
+    return 1 if loaded or extra or (args.max_import_ms and new * 1000 > args.max_import_ms) else 0
+
+
+def bench_compare(args):
+    """Compare the --json results with the --baseline results stage by stage.
+
+    Stages slower than the baseline by more than --threshold are flagged and make the exit code 1.
+    """
+    with open(args.baseline, 'r') as f:
+        baseline = {(r['name'], r['n']): r['ms'] for r in json.load(f)['results']}
+    with open(args.json, 'r') as f:
+        results = json.load(f)['results']
+    regressions = 0
+    for r in results:
+        old = baseline.get((r['name'], r['n']))
+        if old is None:
+            continue
+        ratio = r['ms'] / max(old, 1e-9)
+        status = ''
+        if max(old, r['ms']) >= args.min_time:
+            if ratio > 1 + args.threshold:
+                status, regressions = 'REGRESSION', regressions + 1
+            elif ratio < 1 / (1 + args.threshold):
+                status = 'faster'
+        print(f'{r["name"]:32s} n={r["n"]:>9d}  baseline {old:10.1f} ms  now {r["ms"]:10.1f} ms  {ratio:6.2f}x  {status}')
+    print(f'{regressions} regressions over {args.threshold:.0%} in {len(results)} results')
+    sys.exit(1 if regressions else 0)
+
+
+BENCHMARKS = {
+    'color_map': bench_color_map,
+    'cull': bench_cull,
+    'fps': bench_fps,
+    'grid': bench_grid,
+    'load': bench_load,
+    'mask': bench_mask,
+    'median': bench_median,
+    'raster': bench_raster,
+    'sampler': bench_sampler,
+    'serve': bench_serve,
+    'stages': bench_stages,
+    'startup': bench_startup,
+    'tile': bench_tile,
+    'variant': bench_variant,
+    'voxel': bench_voxel,
+    'compare': bench_compare,
+}
+
+
+def main():
+    args = parse_args()
+    code = BENCHMARKS[args.bench](args)
+    if args.json and args.bench != 'compare':
+        with open(args.json, 'w') as f:
+            json.dump({'bench': args.bench, 'argv': sys.argv[1:], 'python': platform.python_version(),
+                       'numpy': np.__version__, 'mitsuba': mi.__version__, 'machine': platform.machine(),
+                       'cpu_count': os.cpu_count(), 'results': RESULTS}, f, indent=2)
+        print(f'{len(RESULTS)} results written to {args.json}')
+    if code:
+        sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+
+class RenderCache:
+    """Size-bounded on-disk store of rendered images, keyed by the scene content.
+
+    Entries are evicted least recently used first, based on their modification time,
+    which is refreshed on every hit. Hit / miss / eviction counts are kept in stats.json.
+    """
+
+    def __init__(self, directory, max_size=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(pcl, **params):
+        # hash of the final colored points and every parameter that changes the image
+        pcl = np.ascontiguousarray(pcl)
+        digest = hashlib.sha256()
+        digest.update(f'{pcl.dtype.str}{pcl.shape}'.encode())
+        digest.update(pcl.data)
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def path(self, key, output):
+        return os.path.join(self.directory, key + os.path.splitext(output)[1])
+
+    def fetch(self, key, output):
+        # copy the cached image to output, returns False on a miss
+        cached = self.path(key, output)
+        if not os.path.exists(cached):
+            self.update_stats(misses=1)
+            print(f'render cache miss {key[:12]}')
+            return False
+        os.utime(cached)
+        shutil.copyfile(cached, output)
+        self.update_stats(hits=1)
+        print(f'render cache hit {key[:12]} -> {output}')
+        return True
+
+    def store(self, key, output):
+        cached = self.path(key, output)
+        shutil.copyfile(output, cached + '.tmp')
+        os.replace(cached + '.tmp', cached)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name == 'stats.json' or name.endswith('.tmp'):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+            evicted += 1
+        if evicted:
+            self.update_stats(evictions=evicted)
+
+    def stats(self):
+        stats_file = os.path.join(self.directory, 'stats.json')
+        if not os.path.exists(stats_file):
+            return {'hits': 0, 'misses': 0, 'evictions': 0}
+        with open(stats_file, 'r') as f:
+            return json.load(f)
+
+    def update_stats(self, **counts):
+        # best effort: concurrent writers may drop an increment, the file itself stays valid
+        stats = self.stats()
+        for name, count in counts.items():
+            stats[name] += count
+        stats_file = os.path.join(self.directory, 'stats.json')
+        with open(stats_file + f'.{os.getpid()}.tmp', 'w') as f:
+            json.dump(stats, f)
+        os.replace(stats_file + f'.{os.getpid()}.tmp', stats_file)
+
+
+def get_cache(config):
+    if not config.cache:
+        return None
+    return RenderCache(config.cache, int(config.cache_size * 1024 * 1024))
@@ -0,0 +1,64 @@
+import json
+import socket
+import http.client
+import numpy as np
+
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def connect(address=DEFAULT_ADDRESS, timeout=None):
+    # host:port, or the path of a Unix socket
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        return http.client.HTTPConnection(host, int(port), timeout=timeout)
+    return UnixHTTPConnection(address, timeout)
+
+
+def request(address, method, path, body=None, headers=None, timeout=None):
+    connection = connect(address, timeout)
+    try:
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, response.getheader('Content-Type'), response.read()
+    finally:
+        connection.close()
+
+
+def render_remote(points, address=DEFAULT_ADDRESS, timeout=None, **options):
+    """Render points (N x 3, N x 4 or N x 6 array) on a main.py --serve server.
+
+    options are main.py arguments without the dashes, e.g. knn=True, rot=[0, 90, 0], spp=64, plus format='png'.
+    Returns the encoded image bytes, or the server's JSON reply when output='<path on the server>' is given.
+    Raises RuntimeError with the server's message when the request fails, status 503 means the queue is full.
+    """
+    points = np.asarray(points)
+    if points.dtype not in (np.float16, np.float32, np.float64):
+        points = points.astype(np.float32)
+    points = np.ascontiguousarray(points)
+    options = {**options, 'shape': list(points.shape), 'dtype': points.dtype.name}
+    status, content_type, body = request(address, 'POST', '/render', points.tobytes(),
+                                         {'X-Render-Options': json.dumps(options)}, timeout)
+    if status != 200:
+        raise RuntimeError(f'render server {status}: {json.loads(body)["error"]}')
+    if content_type == 'application/json':
+        return json.loads(body)
+    return body
+
+
+def server_status(address=DEFAULT_ADDRESS, timeout=None):
+    # worker count, the active / done / failed / rejected request counters and the variant
+    status, _, body = request(address, 'GET', '/status', timeout=timeout)
+    if status != 200:
+        raise RuntimeError(f'render server {status}')
+    return json.loads(body)
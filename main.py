@@ -1,43 +1,74 @@
 import argparse
 import numpy as np
 from utils import load, standardize_bbox, color_map, rotation
-from render import render, render_part, real_time_tool
+from batch import collect_inputs, render_batch
+import profiler
+
+# render (mitsuba, drjit, cv2, scipy) and server are imported by the paths that use them, so --help and
+# the pool workers of other stages start without them
 
 
 def parse_args():
     parser = argparse.ArgumentParser('Point Cloud Visualizer')
-    parser.add_argument('--path', type=str, help='the input file path', default='out_596.ply')
+    parser.add_argument('--path', type=str, help='the input file path, or a directory, glob or .lst file for batch rendering', default='out_596.ply')
     parser.add_argument('--render', help='using mitsuba to create beautiful image with shadow', action='store_true')
     parser.add_argument('--tool', help='using real time point cloud visualization tools', action='store_true')
     parser.add_argument('--num', type=int, help='downsample point num', default=np.inf)
+    parser.add_argument('--sampler', type=str, help='downsampling strategy of --num', choices=['random', 'voxel', 'poisson', 'fps'], default='random')
     parser.add_argument('--knn', help='using KNN color map', action='store_true')
     parser.add_argument('--center_num', type=int, help='KNN center num', default=24)
+    parser.add_argument('--fps_subset', type=int, help='approximate farthest point sampling over this many random points, 0 for exact', default=0)
     parser.add_argument('--part', help='perform KNN clustering on the objects and render each segment separately', action='store_true')
+    parser.add_argument('--jobs', type=int, help='number of worker processes used to render the parts or the batch', default=1)
+    parser.add_argument('--threads', type=int, help='render threads per process, 0 for all cores (split between --jobs workers)', default=0)
+    parser.add_argument('--variant', type=str, help='mitsuba variant, auto prefers llvm_ad_rgb when it works on this machine', default='auto')
     parser.add_argument('--white', help='render white object', action='store_true')
     parser.add_argument('--RGB', nargs='+', help='render object with specific RGB value', default=[])
     parser.add_argument('--rot', nargs='+', help='rotation angle from x,y,z', default=[])
     parser.add_argument('--workdir', type=str, help='workdir', default='workdir')
     parser.add_argument('--output', type=str, help='output file name', default='result.jpg')
+    parser.add_argument('--outdir', type=str, help='output directory of batch rendering', default='outputs')
     parser.add_argument('--res', nargs='+', help='output file resolution', default=[800, 800])
     parser.add_argument('--radius', type=float, help='radius', default=0.025)
     parser.add_argument('--contrast', type=float, help='contrast', default=0.0004)
     parser.add_argument('--separator', type=str, help='text separator', default=",")
-    parser.add_argument('--type', type=str, help='render type, include point and voxel', default="point")
+    parser.add_argument('--type', type=str, help='render type, include point, voxel and mesh (all points merged into one shape)', default="point")
     parser.add_argument('--mask', help='mask the point cloud', action='store_true')
+    parser.add_argument('--mask_center', type=int, help='number of FPS centers the mask is built from', default=128)
+    parser.add_argument('--mask_ratio', type=float, help='fraction of the mask centers that remove points', default=0.5)
+    parser.add_argument('--mask_radius', type=float, help='points closer than this to a mask center are removed', default=0.05)
     parser.add_argument('--view', nargs='+', help='the x,y,z position of camera view point', default=[2.75, 2.75, 2.75])
+    parser.add_argument('--views', nargs='+', help='x,y,z positions of several camera view points, rendered into numbered frames from one scene', default=[])
+    parser.add_argument('--turntable', type=int, help='render this many evenly spaced views around the z axis, starting at --view', default=0)
+    parser.add_argument('--contact_sheet', help='also tile the frames of --views / --turntable into one image', action='store_true')
+    parser.add_argument('--grid', help='render every batch element of --path, or every input file, side by side in one scene', action='store_true')
+    parser.add_argument('--grid_cols', type=int, help='items per row of --grid, 0 for a roughly square grid', default=0)
+    parser.add_argument('--grid_spacing', type=float, help='distance between the item centers of --grid', default=1.2)
+    parser.add_argument('--grid_split', help='also crop every item of --grid out of the image into <output>_<i>', action='store_true')
     parser.add_argument('--translate', nargs='+', help='the x,y,z position of object translate', default=[0, 0, 0])
     parser.add_argument('--scale', nargs='+', help='the x,y,z scale of object', default=[1, 1, 1])
     parser.add_argument('--median', help='using median filter', action='store_true')
+    parser.add_argument('--voxel_size', type=int, help='grid resolution of the median filter', default=64)
+    parser.add_argument('--spp', type=int, help='samples per pixel', default=256)
+    parser.add_argument('--progressive', help='render in passes of increasing sample count, writing the image after each pass', action='store_true')
+    parser.add_argument('--time_budget', type=float, help='progressive mode stops after this many seconds, 0 for no limit', default=0)
+    parser.add_argument('--tolerance', type=float, help='progressive mode stops when a pass changes the image less than this (mean relative change)', default=0)
+    parser.add_argument('--cull', help='leave out the points the camera and the light can not see before building the scene', action='store_true')
+    parser.add_argument('--cull_margin', type=float, help='--cull keeps the points within this many radii of a visible point', default=2)
+    parser.add_argument('--tile', type=int, help='render in tiles of this many pixels on --jobs processes, finished tiles are checkpointed in workdir', default=0)
+    parser.add_argument('--cache', type=str, help='render cache directory, disabled when not set', default=None)
+    parser.add_argument('--cache_size', type=float, help='render cache size limit in MB', default=1024)
+    parser.add_argument('--xml', help='dump the mitsuba scene as xml into workdir for debugging', action='store_true')
+    parser.add_argument('--profile', type=str, help='write a profile of every pipeline stage to this file', default=None)
+    parser.add_argument('--profile_format', type=str, help='json report or chrome trace', choices=['json', 'trace'], default='json')
+    parser.add_argument('--profile_memory', help='also record the tracemalloc peak of every stage (slower)', action='store_true')
+    parser.add_argument('--serve', help='run a render server that keeps the imports and the mitsuba variant loaded', action='store_true')
+    parser.add_argument('--address', type=str, help='host:port of the render server, or the path of a unix socket', default='127.0.0.1:8765')
+    parser.add_argument('--queue', type=int, help='requests the render server queues beyond the --jobs running ones', default=16)
 
     args = parser.parse_args()
     return args
 
-import matplotlib
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from mpl_toolkits.mplot3d.art3d import Poly3DCollection
-
 def visualize_pointcloud(points, normals=None,out_file=None, show=False, elev=30, azim=225):
     r''' Visualizes point cloud data.
     Args:
@@ -46,6 +77,11 @@ def visualize_pointcloud(points, normals=None,out_file=None, show=False, elev=30
     out_file (string): output file
     show (bool): whether the plot should be shown
     '''
+    import matplotlib
+    matplotlib.use('agg')
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D
+
     # Create plot
     fig = plt.figure()
     ax = fig.gca(projection=Axes3D.name)
@@ -71,34 +107,98 @@ def visualize_pointcloud(points, normals=None,out_file=None, show=False, elev=30
 
 def main():
     config = parse_args()
+    profiler.start(config)
+    from render import resolve_variant
+    # resolved once here, so pool workers do not probe the backends again
+    config.variant = resolve_variant(config)
+
+    if config.serve:
+        from server import serve
+        serve(config, pipeline)
+        profiler.write_report(config)
+        return
+
+    with profiler.stage('total'):
+        paths = collect_inputs(config.path)
+        if paths == []:
+            print(f'no inputs: {config.path} matches no point cloud file')
+        elif config.grid:
+            compose(config, paths or [config.path])
+        elif paths is not None:
+            render_batch(config, paths, run)
+        else:
+            run(config)
+    profiler.write_report(config)
+
+
+def run(config):
     # if config.render and config.tool:
     #     raise RuntimeWarning('both render and real time tool are selected')
     # if config.render is False and config.tool is False:
     #     raise RuntimeWarning('you need to choose one of render or real time tool')
 
+    # batch items run in pool workers, which profile into their own part file
+    profiler.enable(config)
+
     # load the point cloud
-    pcl = load(config.path, config.separator)
+    with profiler.stage('load', path=config.path) as record:
+        pcl = load(config.path, config.separator)
+        record['points_out'] = len(pcl)
+
+    pipeline(config, pcl)
+    profiler.flush()
+
+    # if config.part:
+    #     render_part(config, pcl)
+    # elif config.render:
+    #     render(config, pcl)
+    # else:
+    #     real_time_tool(config, pcl.xyz)
+
+
+def compose(config, paths):
+    # --grid: every input file and every batch element, prepared one by one and rendered in one scene
+    from render import render_grid
+    clouds = []
+    for path in paths:
+        with profiler.stage('load', path=path) as record:
+            items = load(path, config.separator, batch=True)
+            record['points_out'] = sum(len(pcl) for pcl in items)
+        clouds.extend(prepare(config, pcl) for pcl in items)
+    with profiler.stage('render_grid', items=len(clouds)):
+        render_grid(config, clouds)
+
+
+def pipeline(config, pcl):
+    # everything after loading, shared by run and the --serve workers
+    pcl = prepare(config, pcl)
+
+    from render import render, render_part
+    if config.part:
+        with profiler.stage('render_part', points_in=len(pcl)):
+            render_part(config, pcl)
+    else:
+        with profiler.stage('render', points_in=len(pcl)):
+            render(config, pcl)
+
 
+def prepare(config, pcl):
     # standardize the point cloud
-    pcl = standardize_bbox(config, pcl)
+    with profiler.stage('standardize_bbox', points_in=len(pcl)) as record:
+        pcl = standardize_bbox(config, pcl)
+        record['points_out'] = len(pcl)
 
     # rotate the point
     if len(config.rot) != 0:
         assert len(config.rot) == 3
-        rot_matrix = rotation(config.rot)
-        pcl[:, :3] = np.matmul(pcl[:, :3], rot_matrix)
+        with profiler.stage('rotation', points_in=len(pcl)):
+            rot_matrix = rotation(config.rot)
+            pcl.xyz = np.matmul(pcl.xyz, rot_matrix.astype(np.float32))
 
     # color the point cloud
-    pcl = color_map(config, pcl)
-
-    render(config, pcl)
-
-    # if config.part:
-    #     render_part(config, pcl)
-    # elif config.render:
-    #     render(config, pcl)
-    # else:
-    #     real_time_tool(config, pcl[:, :3])
+    with profiler.stage('color_map', points_in=len(pcl)):
+        pcl = color_map(config, pcl)
+    return pcl
 
 
 if __name__ == '__main__':
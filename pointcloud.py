@@ -0,0 +1,70 @@
+import numpy as np
+
+
+def to_float32(xyz):
+    """N x 3 float32 copy of the coordinates xyz.
+
+    Wider coordinates (float64, integers) are centered on their bounding box in their own precision first,
+    column by column, so georeferenced clouds with large offsets keep their detail and no full-size float64
+    intermediate is allocated.
+    """
+    if (xyz.dtype.kind == 'f' and xyz.dtype.itemsize <= 4) or len(xyz) == 0:
+        return xyz.astype(np.float32)
+    out = np.empty(xyz.shape, dtype=np.float32)
+    for i in range(xyz.shape[1]):
+        column = xyz[:, i]
+        center = (np.float64(column.min()) + np.float64(column.max())) / 2
+        np.subtract(column, center, out=out[:, i], casting='same_kind')
+    return out
+
+
+class PointCloud:
+    """N points as a float32 xyz buffer plus an optional per-point color buffer.
+
+    color is N x 3 rgb, either uint8 (0-255, as stored in ply files) or float16 in [0, 1], or N x 1 float32
+    values for the 1-d color map. The pipeline stages modify these buffers in place or replace them and
+    return the cloud. take(), copy(), from_array() and array() allocate new buffers, nothing else copies.
+    """
+
+    def __init__(self, xyz, color=None):
+        self.xyz = xyz
+        self.color = color
+
+    @classmethod
+    def from_array(cls, data):
+        # N x 3, N x 4 (value) or N x 6 (rgb in [0, 1]) array of any float type, e.g. a memory-mapped file
+        xyz = to_float32(data[:, :3])
+        color = None
+        if data.shape[1] == 6:
+            color = data[:, 3:6].astype(np.float16)
+        elif data.shape[1] == 4:
+            color = data[:, 3:4].astype(np.float32)
+        return cls(xyz, color)
+
+    def __len__(self):
+        return self.xyz.shape[0]
+
+    @property
+    def channels(self):
+        return 3 if self.color is None else 3 + self.color.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.xyz.nbytes + (0 if self.color is None else self.color.nbytes)
+
+    def take(self, index):
+        # new cloud of the selected rows
+        return PointCloud(self.xyz[index], None if self.color is None else self.color[index])
+
+    def copy(self):
+        return PointCloud(self.xyz.copy(), None if self.color is None else self.color.copy())
+
+    def array(self):
+        # N x channels float32 array with colors in [0, 1], for the array based helpers and the scene builders
+        out = np.empty((len(self), self.channels), dtype=np.float32)
+        out[:, :3] = self.xyz
+        if self.color is not None:
+            out[:, 3:] = self.color
+            if self.color.dtype == np.uint8:
+                out[:, 3:] *= np.float32(1 / 255)
+        return out
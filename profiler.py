@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    # Windows, the profile records no max_rss_mb
+    resource = None
+
+# per-process state, set by enable() when --profile is given
+_events = None
+_stack = []
+_parts = None
+_memory = False
+
+
+class _Disabled:
+    # returned by stage() when profiling is off, so an instrumented stage costs one call and a dict
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Stage:
+    def __init__(self, name, info):
+        self.record = {'name': name, **info}
+
+    def __enter__(self):
+        if _memory:
+            if _stack:
+                _stack[-1]['_peak'] = max(_stack[-1]['_peak'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.record['_peak'] = 0
+        _stack.append(self.record)
+        self.record['ts'] = time.time()
+        self._wall, self._cpu = time.perf_counter(), time.process_time()
+        return self.record
+
+    def __exit__(self, *exc):
+        record = self.record
+        record['wall'] = time.perf_counter() - self._wall
+        record['cpu'] = time.process_time() - self._cpu
+        if resource is not None:
+            # ru_maxrss is in bytes on macOS, in KB elsewhere
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            record['max_rss_mb'] = max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        record['pid'] = os.getpid()
+        _stack.pop()
+        peak = record.pop('_peak')
+        if _memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            record['peak_traced_mb'] = peak / 1024 / 1024
+            if _stack:
+                _stack[-1]['_peak'] = max(_stack[-1]['_peak'], peak)
+            tracemalloc.reset_peak()
+        if exc[0] is not None:
+            record['error'] = exc[0].__name__
+        _events.append(record)
+        return False
+
+
+def stage(name, **info):
+    """Context manager timing one pipeline stage, yields a dict for extra fields such as points_out.
+
+    Records wall and cpu time, the process peak RSS and, with --profile_memory, the tracemalloc peak.
+    """
+    if _events is None:
+        return _Disabled()
+    return _Stage(name, info)
+
+
+def enable(config):
+    # called in the main process and in every pool worker, a no-op without --profile
+    global _events, _parts, _memory
+    if not config.profile or _events is not None:
+        return
+    _events, _parts, _memory = [], config.profile + '.parts', config.profile_memory
+    if _memory:
+        tracemalloc.start()
+
+
+def flush():
+    # appends the events of this process to <profile>.parts/<pid>.jsonl, pool workers exit without notice
+    if not _events:
+        return
+    os.makedirs(_parts, exist_ok=True)
+    with open(os.path.join(_parts, f'{os.getpid()}.jsonl'), 'a') as f:
+        for record in _events:
+            f.write(json.dumps(record, default=float) + '\n')
+    _events.clear()
+
+
+def start(config):
+    # main process: drop the parts a previous run may have left behind
+    if config.profile:
+        shutil.rmtree(config.profile + '.parts', ignore_errors=True)
+    enable(config)
+
+
+def write_report(config):
+    """Merge the events of all processes into config.profile.
+
+    json: the stage records and a per-stage summary. trace: Chrome trace events for chrome://tracing or Perfetto.
+    """
+    if not config.profile:
+        return
+    flush()
+    events = []
+    if os.path.isdir(_parts):
+        for name in sorted(os.listdir(_parts)):
+            with open(os.path.join(_parts, name), 'r') as f:
+                events.extend(json.loads(line) for line in f)
+        shutil.rmtree(_parts)
+    events.sort(key=lambda e: e['ts'])
+
+    if config.profile_format == 'trace':
+        fields = ('name', 'ts', 'wall', 'pid')
+        report = {'traceEvents': [{'name': e['name'], 'ph': 'X', 'ts': e['ts'] * 1e6, 'dur': e['wall'] * 1e6,
+                                   'pid': e['pid'], 'tid': e['pid'],
+                                   'args': {k: v for k, v in e.items() if k not in fields}} for e in events],
+                  'displayTimeUnit': 'ms'}
+    else:
+        summary = {}
+        for e in events:
+            total = summary.setdefault(e['name'], {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+            total['count'] += 1
+            total['wall'] += e['wall']
+            total['cpu'] += e['cpu']
+        report = {'summary': summary, 'stages': events}
+    with open(config.profile, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'profile of {len(events)} stages written to {config.profile}')
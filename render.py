@@ -1,98 +1,528 @@
 import os
+import sys
+import copy
+import json
 import time
+import shutil
+import subprocess
+import multiprocessing
 import numpy as np
+import drjit as dr
 import mitsuba as mi
-import simple3d
-from utils import standardize_bbox, generate_pos_colormap, get_xml, fps, mask_point
+import profiler
+from cache import RenderCache, get_cache
+from utils import normalize_bbox, generate_pos_colormap, get_xml, get_scene_dict, get_sensor_dict, fps, mask_point, \
+    get_point_mesh, get_voxel_mesh, write_mesh_ply
+
+
+def write_xml(config, pcl, xmlFile, views=None):
+    os.makedirs(config.workdir, exist_ok=True)
+    xml_head, xml_object_segment, xml_tail = get_xml(config.res, config.view, config.radius, config.type, config.spp,
+                                                     views)
+    xml_segments = [xml_head]
+    if config.type in ("mesh", "voxel"):
+        plyFile = xmlFile[:-len('.xml')] + '.ply'
+        get_mesh = get_point_mesh if config.type == "mesh" else get_voxel_mesh
+        write_mesh_ply(plyFile, *get_mesh(pcl, float(config.radius)))
+        xml_segments.append(xml_object_segment.format(os.path.abspath(plyFile)))
+    else:
+        for i in range(pcl.shape[0]):
+            xml_segments.append(xml_object_segment.format(*pcl[i, :6]))
+    xml_segments.append(xml_tail)
+    xml_content = str.join('', xml_segments)
+
+    with open(xmlFile, 'w') as f:
+        f.write(xml_content)
+    print(f'scene xml written to {xmlFile}')
+
+
+def load_scene(config, pcl, name, views=None):
+    # pcl: N x 6 points in scene coordinates, views: camera positions of the sensors, defaults to config.view
+    if config.xml:
+        xmlFile = f'{config.workdir}/{name}.xml'
+        write_xml(config, pcl, xmlFile, views)
+        return mi.load_file(xmlFile)
+    return mi.load_dict(get_scene_dict(pcl, config.res, config.view, config.radius, config.type, config.spp, views))
+
+
+def render_image(config, scene, output_file, sensor=0):
+    """Render the given sensor of scene with config.spp samples per pixel into output_file, returns the samples
+    actually taken.
+
+    In progressive mode the samples are taken in passes of doubling size, starting at 16. The running
+    average is written after every pass, and rendering stops early once config.time_budget seconds
+    have passed or the mean relative change of a pass drops below config.tolerance.
+    """
+    if not config.progressive:
+        image = mi.render(scene, sensor=sensor, spp=config.spp)
+        mi.util.write_bitmap(output_file, image, write_async=False)
+        return config.spp
+
+    start = time.perf_counter()
+    image, done, step = None, 0, min(16, config.spp)
+    while done < config.spp:
+        step = min(step, config.spp - done)
+        current = np.array(mi.render(scene, sensor=sensor, spp=step, seed=done))
+        previous = image
+        image = current if image is None else (image * done + current * step) / (done + step)
+        done += step
+        mi.util.write_bitmap(output_file, image, write_async=False)
+
+        elapsed = time.perf_counter() - start
+        change = np.inf if previous is None else np.mean(np.abs(image - previous)) / max(np.mean(image), 1e-8)
+        print(f'progressive: {done} spp in {elapsed:.2f}s, change {change:.5f} -> {output_file}')
+        if config.time_budget > 0 and elapsed >= config.time_budget:
+            break
+        if change < config.tolerance:
+            break
+        step *= 2
+    return done
+
+
+def cache_key(config, pcl, view):
+    # pcl: N x 6 points in scene coordinates
+    # --translate and --scale are already applied to the points by scene_points
+    return RenderCache.key(pcl, res=[int(r) for r in config.res], view=[float(v) for v in view],
+                           radius=float(config.radius), type=config.type, spp=config.spp, variant=config.variant,
+                           cull=float(config.cull_margin) if config.cull else None)
+
+
+# renders a tiny scene with every shape type of get_scene_dict, run in a child process by resolve_variant
+PROBE = '''
+import sys
+import numpy as np
+import mitsuba as mi
+mi.set_variant(sys.argv[1])
+from utils import get_scene_dict
+pcl = np.array([[0, 0, 0, 1, 0, 0], [0.1, 0.1, 0.1, 0, 1, 0]])
+for object_type in ("point", "voxel", "mesh"):
+    mi.render(mi.load_dict(get_scene_dict(pcl, [8, 8], [2, 2, 2], 0.05, object_type, 1)), spp=1)
+'''
+
+
+def probe_variant(variant, workdir):
+    """True when variant can render on this machine.
+
+    The check runs in a child process because a broken LLVM backend aborts the process instead of raising.
+    The result is kept in <workdir>/variants.json per mitsuba / drjit version and LLVM library.
+    """
+    if variant not in mi.variants():
+        return False
+    key = f'{variant} mitsuba {mi.__version__} drjit {dr.__version__} {os.environ.get("DRJIT_LIBLLVM_PATH", "")}'
+    probe_file = os.path.join(workdir, 'variants.json')
+    probes = {}
+    if os.path.exists(probe_file):
+        with open(probe_file, 'r') as f:
+            probes = json.load(f)
+    if key not in probes:
+        print(f'checking the {variant} backend ...')
+        try:
+            result = subprocess.run([sys.executable, '-c', PROBE, variant], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    capture_output=True, timeout=600)
+            probes[key] = result.returncode == 0
+        except subprocess.TimeoutExpired:
+            probes[key] = False
+        os.makedirs(workdir, exist_ok=True)
+        with open(probe_file, 'w') as f:
+            json.dump(probes, f, indent=2)
+    return probes[key]
+
+
+def resolve_variant(config):
+    # --variant auto prefers the JIT compiled, vectorized llvm_ad_rgb CPU backend and falls back to scalar_rgb
+    if config.variant != 'auto':
+        return config.variant
+    variant = 'llvm_ad_rgb' if probe_variant('llvm_ad_rgb', config.workdir) else 'scalar_rgb'
+    print(f'mitsuba variant: {variant}')
+    return variant
+
+
+def render_threads(config):
+    # --threads, or an equal share of the cores for each of the --jobs worker processes, 0 keeps the default
+    if config.threads > 0:
+        return config.threads
+    if config.jobs > 1:
+        return max(1, os.cpu_count() // config.jobs)
+    return 0
+
+
+def setup_backend(config):
+    # sets the variant and the render thread count once per process, later calls are no-ops
+    variant = resolve_variant(config)
+    if mi.variant() != variant:
+        mi.set_variant(variant)
+    threads = render_threads(config)
+    if threads > 0 and dr.thread_count() != threads:
+        dr.set_thread_count(threads)
 
 
 def render(config, pcl):
+    # pcl: colored PointCloud, left unchanged, the scene gets its own N x 6 float32 array
     file_name = config.path.split('.')[0]
-    pcl[:, 2] *= -1
-    pcl[:, 1] -= min(pcl[:, 1]) + 0.25
+    render_views(config, scene_points(config, pcl), file_name.split("/")[-1], config.output)
+
+
+def scene_points(config, pcl):
+    # N x 6 float32 array of the colored PointCloud in scene coordinates: z up, resting on the floor
+    scene_pcl = pcl.array()
+    scene_pcl[:, 2] *= -1
+    scene_pcl[:, 1] -= scene_pcl[:, 1].min() + 0.25
 
     if config.mask:
-        pcl = mask_point(pcl)
+        with profiler.stage('mask_point', points_in=len(scene_pcl)) as record:
+            scene_pcl = mask_point(scene_pcl, config.mask_center, config.mask_ratio, config.mask_radius,
+                                   config.fps_subset)
+            record['points_out'] = len(scene_pcl)
 
-    xml_head, xml_object_segment, xml_tail = get_xml(config.res, config.view, config.radius, config.type)
-    xml_segments = [xml_head]
+    # xyz -> zxy, scaled and translated in place, with a single column as scratch space
+    z = scene_pcl[:, 2].copy()
+    scene_pcl[:, 2] = scene_pcl[:, 1]
+    scene_pcl[:, 1] = scene_pcl[:, 0]
+    scene_pcl[:, 0] = z
+    del z
+    scene_pcl[:, :3] *= np.array(config.scale, dtype=np.float32)
+    scene_pcl[:, :3] += np.array(config.translate, dtype=np.float32)
+    return scene_pcl
 
-    translate = list(map(float, config.translate))
-    scale = list(map(float, config.scale))
 
-    for i in range(pcl.shape[0]):
-        x, y, z = np.roll(pcl[i, :3], 1) * scale + translate
-        color = pcl[i, 3:]
-        xml_segments.append(xml_object_segment.format(x, y, z, *color))
+def grid_layout(config, count):
+    """Floor offsets of count items in rows of --grid_cols, about square by default.
 
-    xml_segments.append(xml_tail)
-    xml_content = str.join('', xml_segments)
+    The rows run across the --view direction, item 0 is at the back left as seen from the camera.
+    """
+    columns = config.grid_cols or int(np.ceil(np.sqrt(count)))
+    rows = (count + columns - 1) // columns
+    view = np.array(config.view, dtype=float)
+    depth = -view[:2] / np.linalg.norm(view[:2]) if np.linalg.norm(view[:2]) > 1e-6 else np.array([0.0, 1.0])
+    right = np.array([depth[1], -depth[0]])
+    row, column = np.divmod(np.arange(count), columns)
+    offsets = np.zeros((count, 3), dtype=np.float32)
+    offsets[:, :2] = ((column - (columns - 1) / 2)[:, None] * right +
+                      ((rows - 1) / 2 - row)[:, None] * depth) * config.grid_spacing
+    return offsets
 
-    os.makedirs(config.workdir, exist_ok=True)
-    xmlFile = f'{config.workdir}/{file_name.split("/")[-1]}.xml'
-    with open(xmlFile, 'w') as f:
-        f.write(xml_content)
-    f.close()
 
-    mi.set_variant("scalar_rgb")
-    scene = mi.load_file(xmlFile)
-    image = mi.render(scene, spp=256)
-    mi.util.write_bitmap(config.output, image)
-    # To prevent errors in the output image, we delay some seconds
-    time.sleep(int(config.res[0]) / 1000)
-    os.remove(xmlFile)
+def compose_grid(config, clouds):
+    # scene points of the colored PointClouds laid out side by side, their bounding box corners and the camera
+    # position that frames all of them
+    parts = [scene_points(config, pcl) for pcl in clouds]
+    for part, offset in zip(parts, grid_layout(config, len(clouds))):
+        part[:, :3] += offset
+    boxes = [bounding_corners(part) for part in parts]
+    return np.concatenate(parts), boxes, fit_view(config, np.concatenate(boxes))
+
+
+def render_grid(config, clouds, name='grid'):
+    """Render the colored PointClouds side by side in one scene, with one floor, one light and one render.
+
+    With --grid_split every item is also cropped out of the image into <output>_<i>.
+    """
+    scene_pcl, boxes, view = compose_grid(config, clouds)
+    grid_config = copy.copy(config)
+    grid_config.view = view
+    print(f'grid of {len(boxes)} items, {len(scene_pcl)} points')
+    render_views(grid_config, scene_pcl, name, config.output)
+
+    if config.grid_split:
+        if get_views(grid_config) is not None:
+            print('--grid_split is skipped for --views and --turntable')
+            return
+        import cv2
+        image = cv2.imread(config.output, cv2.IMREAD_UNCHANGED)
+        stem, extension = config.output.rsplit('.', 1)
+        for i, corners in enumerate(boxes):
+            (left, top), (right, bottom) = grid_crop(project(grid_config, corners), image.shape)
+            cv2.imwrite(f'{stem}_{i}.{extension}', image[top:bottom, left:right])
+        print(f'{len(boxes)} crops written to {stem}_<i>.{extension}')
+
+
+FOV = 25.0  # horizontal field of view of the sensor of get_scene_dict and get_xml, in degrees
+LIGHT = [-4, 4, 20]  # center of the area light of get_scene_dict and get_xml
+FLOOR = -0.3  # height of the floor of get_scene_dict and get_xml
+
+
+def hidden_point_removal(xyz, viewpoint, gamma=3):
+    """Indices of the points visible from viewpoint, by the hidden point removal operator of Katz et al.:
+    the points are flipped about a large sphere around viewpoint and the visible ones end up on the convex hull.
+
+    A larger gamma keeps more points in concave regions.
+    """
+    from scipy.spatial import ConvexHull, QhullError
+    local = xyz - viewpoint
+    norm = np.linalg.norm(local, axis=1, keepdims=True)
+    flipped = local + 2 * (norm.max() * 10 ** gamma - norm) * local / norm
+    try:
+        vertices = ConvexHull(np.concatenate((flipped, np.zeros((1, 3))))).vertices
+    except QhullError:
+        # degenerate clouds, e.g. all points on a line
+        return np.arange(len(xyz))
+    return vertices[vertices < len(xyz)]
+
+
+def cull_hidden(config, pcl, views):
+    """Drop the points of pcl (N x 6, scene coordinates) that neither a camera of views, nor its mirror image
+    in the glossy floor, nor the light can see.
+
+    Points within --cull_margin radii of a visible point are kept too, so the spheres that peek out from
+    behind a silhouette or into a gap stay.
+    """
+    from scipy.spatial import cKDTree
+    if len(pcl) < 16:
+        return pcl
+    xyz = pcl[:, :3].astype(np.float64)
+    # --view comes from the command line as strings
+    views = np.asarray(views, dtype=float)
+    viewpoints = [point for x, y, z in views for point in ([x, y, z], [x, y, 2 * FLOOR - z])] + [LIGHT]
+    visible = np.zeros(len(pcl), dtype=bool)
+    for viewpoint in viewpoints:
+        visible[hidden_point_removal(xyz, np.array(viewpoint, dtype=float))] = True
+    if config.cull_margin > 0 and not visible.all():
+        distance, _ = cKDTree(xyz[visible]).query(xyz[~visible],
+                                                  distance_upper_bound=config.cull_margin * float(config.radius))
+        visible[~visible] = np.isfinite(distance)
+    print(f'cull: {visible.sum()} of {len(pcl)} points visible, {len(pcl) - visible.sum()} culled')
+    return pcl[visible]
+
+
+def bounding_corners(pcl):
+    # the 8 corners of the axis aligned bounding box of the points
+    return np.array(np.meshgrid(*zip(pcl[:, :3].min(axis=0), pcl[:, :3].max(axis=0)))).reshape(3, -1).T
+
+
+def camera_axes(view):
+    # forward, left and up unit vectors of the look_at camera at view, aimed at the origin with z up
+    forward = -np.array(view, dtype=float) / np.linalg.norm(view)
+    left = np.cross([0, 0, 1], forward)
+    left /= np.linalg.norm(left)
+    return forward, left, np.cross(forward, left)
+
+
+def fit_view(config, points, fill=0.9):
+    """Camera position in the --view direction, at least as far as --view, with every point inside
+    fill of the image width and height."""
+    forward, left, up = camera_axes(config.view)
+    tan_x = fill * np.tan(np.radians(FOV) / 2)
+    tan_y = tan_x * int(config.res[1]) / int(config.res[0])
+    # a point p is inside when |p.left| <= tan_x * depth and |p.up| <= tan_y * depth, depth = distance + p.forward
+    distance = -points @ forward + np.maximum(np.abs(points @ left) / tan_x, np.abs(points @ up) / tan_y)
+    return (-forward * max(np.linalg.norm(np.array(config.view, dtype=float)), distance.max())).tolist()
+
+
+def project(config, points):
+    # pixel coordinates of scene points in the image of the camera at config.view
+    width, height = int(config.res[0]), int(config.res[1])
+    forward, left, up = camera_axes(config.view)
+    local = points - np.array(config.view, dtype=float)
+    scale = width / 2 / np.tan(np.radians(FOV) / 2) / (local @ forward)
+    return np.stack((width / 2 - local @ left * scale, height / 2 - local @ up * scale), axis=1)
+
+
+def grid_crop(pixels, shape, margin=0.05):
+    # bounding box of the projected item, padded and clipped to the image
+    low, high = pixels.min(axis=0), pixels.max(axis=0)
+    pad = margin * (high - low).max()
+    left, top = np.clip(np.floor(low - pad).astype(int), 0, None)
+    right, bottom = np.minimum(np.ceil(high + pad).astype(int), [shape[1], shape[0]])
+    return (left, top), (right, bottom)
 
 
 def render_part(config, pcl):
+    # pcl: PointCloud, the parts are colored by position so only its xyz is used
+    from scipy.spatial import cKDTree
     file_name = config.path.split('.')[0]
-    pcl = pcl[:, [2, 0, 1]]
+    pcl = pcl.xyz[:, [2, 0, 1]]
     pcl[:, 0] *= -1
     pcl[:, 2] += 0.0125
 
-    knn_center = fps(pcl, config.center_num)
-    knn_center += 0.5
-    knn_center[:, 2] -= 0.0125
+    with profiler.stage('fps', points_in=pcl.shape[0], k=config.center_num):
+        knn_center = fps(pcl, config.center_num, config.fps_subset)
 
     # config.res[0] /= 2
     # config.res[1] /= 2
     config.radius *= 2
 
-    pcl_list = [[] for i in range(config.center_num)]
-    for i in range(pcl.shape[0]):
-        x, y, z = pcl[i, 0] + 0.5, pcl[i, 1] + 0.5, pcl[i, 2] + 0.5 - 0.0125
-        temp = abs(knn_center[:, 0] - x) + abs(knn_center[:, 1] - y) + abs(knn_center[:, 2] - z)
-        index = np.argmin(temp)
-        pcl_list[index].append(pcl[i])
+    # L1-nearest center for every point, patches keep the input point order
+    _, index = cKDTree(knn_center[:, :3]).query(pcl[:, :3], p=1)
+    order = np.argsort(index, kind='stable')
+    patches = np.split(pcl[order], np.cumsum(np.bincount(index, minlength=config.center_num))[:-1])
+
+    name, extension = config.output.rsplit('.', 1)
+    tasks = [(config, patches[i], f'{file_name.split("/")[-1]}_{i}', f'{name}_{i}.{extension}')
+             for i in range(config.center_num) if len(patches[i]) > 0]
+    if config.jobs > 1:
+        with multiprocessing.get_context('spawn').Pool(config.jobs) as pool:
+            pool.starmap(render_patch, tasks)
+    else:
+        for task in tasks:
+            render_patch(*task)
+
+
+def render_patch(config, knn_patch, name, output_file):
+    # renders one render_part segment, runs in a pool worker when --jobs > 1
+    profiler.enable(config)
+    knn_patch = normalize_bbox(knn_patch)
+    color = generate_pos_colormap(knn_patch + 0.5, config)
+    knn_patch = np.concatenate((knn_patch, color), axis=1)
+
+    with profiler.stage('render_patch', points_in=knn_patch.shape[0], output=output_file):
+        render_views(config, knn_patch, name, output_file)
+    profiler.flush()
+
+
+def get_views(config):
+    # camera positions of --turntable or --views, None for a single --view image
+    if config.turntable > 0:
+        # evenly spaced azimuths around the z axis, starting at --view and keeping its distance and height
+        x, y, z = map(float, config.view)
+        angles = np.arctan2(y, x) + 2 * np.pi * np.arange(config.turntable) / config.turntable
+        return [[np.hypot(x, y) * np.cos(a), np.hypot(x, y) * np.sin(a), z] for a in angles]
+    if len(config.views) > 0:
+        assert len(config.views) % 3 == 0, '--views takes x y z triples'
+        return np.array(config.views, dtype=float).reshape(-1, 3).tolist()
+    return None
+
+
+def render_views(config, pcl, name, output_file):
+    """Render pcl (N x 6 points in scene coordinates) into output_file, or into numbered frames
+    <output>_000, <output>_001, ... when get_views returns several cameras.
+
+    All the views are sensors of one scene, so the geometry is loaded and its acceleration structure
+    built once. Views found in the render cache are left out of the scene.
+    """
+    views = get_views(config)
+    if views is None:
+        views, outputs = [config.view], [output_file]
+    else:
+        stem, extension = output_file.rsplit('.', 1)
+        outputs = [f'{stem}_{i:03d}.{extension}' for i in range(len(views))]
+
+    cache = get_cache(config)
+    keys = [cache_key(config, pcl, view) for view in views] if cache is not None else None
+    todo = [i for i in range(len(views)) if cache is None or not cache.fetch(keys[i], outputs[i])]
+
+    if todo and config.cull:
+        with profiler.stage('cull', points_in=len(pcl), views=len(todo)) as record:
+            pcl = cull_hidden(config, pcl, [views[i] for i in todo])
+            record['points_out'] = len(pcl)
+
+    if todo and config.tile > 0:
+        # the tile workers build the scene themselves
+        for i in todo:
+            with profiler.stage('render_tiled', output=outputs[i], spp=config.spp, tile=config.tile):
+                render_tiled(config, pcl, name, views[i], outputs[i])
+            if cache is not None:
+                cache.store(keys[i], outputs[i])
+    elif todo:
+        setup_backend(config)
+        start = time.perf_counter()
+        with profiler.stage('load_scene', points_in=pcl.shape[0], type=config.type, views=len(todo)) as record:
+            scene = load_scene(config, pcl, name, [views[i] for i in todo])
+            record['primitives'] = len(scene.shapes())
+        print(f'scene loaded in {time.perf_counter() - start:.2f}s')
+        for sensor, i in enumerate(todo):
+            with profiler.stage('render_image', output=outputs[i], spp=config.spp) as record:
+                spp = render_image(config, scene, outputs[i], sensor)
+                record['spp_done'] = spp
+            if cache is not None and spp == config.spp:
+                cache.store(keys[i], outputs[i])
+
+    if len(outputs) > 1 and config.contact_sheet:
+        stem, extension = output_file.rsplit('.', 1)
+        write_contact_sheet(outputs, f'{stem}_sheet.{extension}')
+
+
+# scene of a tile worker, set by load_tile_scene
+_tile_state = None
+TILE_MARGIN = 4  # pixels rendered around every tile, more than the radius of the gaussian reconstruction filter
+
+
+def tile_windows(width, height, tile):
+    # (x, y, width, height) of the tiles, row by row
+    return [(x, y, min(tile, width - x), min(tile, height - y))
+            for y in range(0, height, tile) for x in range(0, width, tile)]
+
+
+def load_tile_scene(config, pcl, name, view):
+    # pool initializer of render_tiled, every worker builds the scene once
+    global _tile_state
+    setup_backend(config)
+    profiler.enable(config)
+    _tile_state = (config, view, load_scene(config, pcl, name, [view]))
+
+
+def render_tile(task):
+    """Render one tile with TILE_MARGIN extra pixels on every side, so the pixels at the tile border also get
+    the filtered samples of their neighbors, as in a single pass. The tile itself is saved to its checkpoint file.
+    """
+    index, (x, y, w, h), tile_file = task
+    config, view, scene = _tile_state
+    width, height = int(config.res[0]), int(config.res[1])
+    left, top = max(0, x - TILE_MARGIN), max(0, y - TILE_MARGIN)
+    right, bottom = min(width, x + w + TILE_MARGIN), min(height, y + h + TILE_MARGIN)
+    sensor = mi.load_dict(get_sensor_dict(view, config.res, config.spp, (left, top, right - left, bottom - top)))
+    with profiler.stage('render_tile', x=x, y=y, spp=config.spp):
+        image = np.array(mi.render(scene, sensor=sensor, spp=config.spp, seed=index))
+    # written under a temporary name first, an interrupted write must not look like a finished tile
+    np.save(tile_file + '.tmp.npy', image[y - top:y - top + h, x - left:x - left + w])
+    os.replace(tile_file + '.tmp.npy', tile_file)
+    profiler.flush()
+
 
-    for i in range(config.center_num):
-        knn_patch = np.array(pcl_list[i])
-        xml_head, xml_object_segment, xml_tail = get_xml(config.res, config.view, config.radius, config.type)
-        xml_segments = [xml_head]
+def render_tiled(config, pcl, name, view, output_file):
+    """Render output_file in --tile x --tile pixel tiles on --jobs worker processes and stitch them.
 
-        knn_patch = standardize_bbox(knn_patch)
-        for j in range(len(knn_patch)):
-            color = generate_pos_colormap(knn_patch[j] + 0.5, config)
-            xml_segments.append(xml_object_segment.format(knn_patch[j, 0], knn_patch[j, 1], knn_patch[j, 2], *color))
+    Finished tiles are kept in <workdir>/tiles/<key>/ until the image is written, so an interrupted render
+    resumes with the missing tiles only.
+    """
+    global _tile_state
+    width, height = int(config.res[0]), int(config.res[1])
+    tile_dir = os.path.join(config.workdir, 'tiles', f'{cache_key(config, pcl, view)}_{config.tile}')
+    os.makedirs(tile_dir, exist_ok=True)
+    tasks = [(i, window, os.path.join(tile_dir, f'{i}.npy'))
+             for i, window in enumerate(tile_windows(width, height, config.tile))]
+    todo = [task for task in tasks if not os.path.exists(task[2])]
+    print(f'tiles: {len(tasks)} tiles of {config.tile} pixels, {len(tasks) - len(todo)} done in a previous run')
 
-        xml_segments.append(xml_tail)
-        xml_content = str.join('', xml_segments)
+    start = time.perf_counter()
+    # a worker of --part or of a batch can not start a pool of its own
+    if config.jobs > 1 and len(todo) > 1 and not multiprocessing.current_process().daemon:
+        with multiprocessing.get_context('spawn').Pool(min(config.jobs, len(todo)), load_tile_scene,
+                                                       (config, pcl, name, view)) as pool:
+            for done, _ in enumerate(pool.imap_unordered(render_tile, todo), 1):
+                print(f'tiles: {done}/{len(todo)} rendered in {time.perf_counter() - start:.2f}s')
+    elif todo:
+        load_tile_scene(config, pcl, name, view)
+        for done, task in enumerate(todo, 1):
+            render_tile(task)
+            print(f'tiles: {done}/{len(todo)} rendered in {time.perf_counter() - start:.2f}s')
+        _tile_state = None
 
-        os.makedirs(config.workdir, exist_ok=True)
-        xmlFile = f'{config.workdir}/{file_name}.xml'
-        with open(xmlFile, 'w') as f:
-            f.write(xml_content)
-        f.close()
+    image = None
+    for _, (x, y, w, h), tile_file in tasks:
+        tile = np.load(tile_file)
+        if image is None:
+            image = np.empty((height, width, tile.shape[2]), dtype=tile.dtype)
+        image[y:y + h, x:x + w] = tile
+    mi.util.write_bitmap(output_file, image, write_async=False)
+    shutil.rmtree(tile_dir)
+    print(f'tiles: stitched into {output_file}')
 
-        mi.set_variant("scalar_rgb")
-        scene = mi.load_file(xmlFile)
-        image = mi.render(scene, spp=256)
 
-        output_file = config.output.split('.')[0] + f'_{str(i)}.' + config.output.split('.')[1]
-        mi.util.write_bitmap(output_file, image)
-        # To prevent errors in the output image, we delay some seconds
-        time.sleep(int(config.res[0]) / 1000)
-        os.remove(xmlFile)
+def write_contact_sheet(files, output_file):
+    # tiles the frames row by row into a roughly square grid
+    import cv2
+    images = [cv2.imread(f, cv2.IMREAD_UNCHANGED) for f in files]
+    height, width = images[0].shape[:2]
+    columns = int(np.ceil(np.sqrt(len(images))))
+    rows = (len(images) + columns - 1) // columns
+    sheet = np.zeros((rows * height, columns * width) + images[0].shape[2:], dtype=images[0].dtype)
+    for i, image in enumerate(images):
+        row, column = divmod(i, columns)
+        sheet[row * height:(row + 1) * height, column * width:(column + 1) * width] = image
+    cv2.imwrite(output_file, sheet)
+    print(f'contact sheet of {len(files)} views written to {output_file}')
 
 
 def real_time_tool(config, pcl):
+    import simple3d
     simple3d.showpoints(pcl, config)
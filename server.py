@@ -0,0 +1,194 @@
+import os
+import copy
+import json
+import time
+import uuid
+import socket
+import signal
+import threading
+import socketserver
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import profiler
+from pointcloud import PointCloud
+from render import setup_backend, get_views
+
+# render options a request may set, everything else is fixed when the server starts
+OPTIONS = ('white', 'RGB', 'knn', 'center_num', 'fps_subset', 'rot', 'num', 'sampler', 'res', 'radius', 'contrast',
+           'type', 'mask', 'mask_center', 'mask_ratio', 'mask_radius', 'view', 'views', 'turntable', 'contact_sheet',
+           'translate', 'scale', 'median', 'voxel_size', 'spp', 'cull', 'cull_margin', 'output', 'format')
+DTYPES = ('float32', 'float64', 'float16')
+CONTENT_TYPES = {'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png', 'exr': 'image/x-exr'}
+
+
+def warm_up(config):
+    # pool initializer: the imports happened when the worker unpickled this function, set the backend once
+    setup_backend(config)
+    profiler.enable(config)
+
+
+def run_job(pipeline, config, body, dtype, shape, temporary):
+    """Render one request in a pool worker.
+
+    Returns the image bytes of a temporary output, None when the request named its own output file(s).
+    """
+    with profiler.stage('serve_job', points_in=shape[0], output=config.output):
+        pcl = PointCloud.from_array(np.frombuffer(body, dtype=dtype).reshape(shape))
+        pipeline(config, pcl)
+    profiler.flush()
+    if not temporary:
+        return None
+    with open(config.output, 'rb') as f:
+        image = f.read()
+    os.remove(config.output)
+    return image
+
+
+class Server:
+    """Keeps --jobs warm worker processes and admits at most --jobs + --queue requests at a time."""
+
+    def __init__(self, config, pipeline):
+        self.config, self.pipeline = config, pipeline
+        self.limit = max(1, config.jobs) + config.queue
+        self.lock = threading.Lock()
+        self.stats = {'active': 0, 'done': 0, 'failed': 0, 'rejected': 0, 'seconds': 0.0}
+        worker_config = copy.copy(config)
+        worker_config.threads = config.threads or max(1, os.cpu_count() // max(1, config.jobs))
+        self.worker_config = worker_config
+        self.executor = ProcessPoolExecutor(max(1, config.jobs), multiprocessing.get_context('spawn'),
+                                            initializer=warm_up, initargs=(worker_config,))
+        # each submit finds no idle worker and starts one, so all of them start now instead of on the first requests
+        list(self.executor.map(time.sleep, [0] * max(1, config.jobs)))
+
+    def job_config(self, options):
+        extension = options.pop('format', self.config.output.rsplit('.', 1)[-1])
+        job_config = copy.copy(self.worker_config)
+        for key, value in options.items():
+            setattr(job_config, key, value)
+        job_config.jobs = 1
+        if 'output' in options:
+            job_config.path = os.path.basename(options['output'])
+        else:
+            if get_views(job_config) is not None:
+                raise ValueError('--views and --turntable write several frames, set "output"')
+            name = f'serve_{uuid.uuid4().hex}'
+            os.makedirs(os.path.join(self.config.workdir, 'serve'), exist_ok=True)
+            job_config.path = name
+            job_config.output = os.path.join(self.config.workdir, 'serve', f'{name}.{extension}')
+        return job_config
+
+    def submit(self, options, body):
+        # raises ValueError on a malformed request, returns None when the queue is full
+        unknown = set(options) - set(OPTIONS) - {'shape', 'dtype'}
+        if unknown:
+            raise ValueError(f'unknown options: {", ".join(sorted(unknown))}')
+        shape, dtype = options.pop('shape', None), options.pop('dtype', 'float32')
+        if dtype not in DTYPES:
+            raise ValueError(f'dtype must be one of {", ".join(DTYPES)}')
+        if shape is None or len(shape) != 2 or shape[1] not in (3, 4, 6) or shape[0] < 1:
+            raise ValueError('shape must be [N, 3], [N, 4] or [N, 6]')
+        if len(body) != shape[0] * shape[1] * np.dtype(dtype).itemsize:
+            raise ValueError(f'expected {shape[0]} x {shape[1]} {dtype} values, got {len(body)} bytes')
+        temporary = 'output' not in options
+        config = self.job_config(options)
+        with self.lock:
+            if self.stats['active'] >= self.limit:
+                self.stats['rejected'] += 1
+                return None
+            self.stats['active'] += 1
+        return config, self.executor.submit(run_job, self.pipeline, config, body, dtype, tuple(shape),
+                                            temporary)
+
+    def finish(self, failed, seconds):
+        with self.lock:
+            self.stats['active'] -= 1
+            self.stats['failed' if failed else 'done'] += 1
+            self.stats['seconds'] += seconds
+
+    def status(self):
+        with self.lock:
+            return {**self.stats, 'jobs': max(1, self.config.jobs), 'limit': self.limit, 'variant': self.config.variant}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send(self, code, body, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self.send(404, {'error': 'not found'})
+        self.send(200, self.server.render_server.status())
+
+    def do_POST(self):
+        """POST /render, the body is the raw N x C point buffer, the X-Render-Options header a JSON object
+        with its shape (and dtype) and any of the OPTIONS."""
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/render':
+            return self.send(404, {'error': 'not found'})
+        server = self.server.render_server
+        start = time.perf_counter()
+        try:
+            job = server.submit(json.loads(self.headers.get('X-Render-Options', '{}')), body)
+        except (ValueError, TypeError) as e:
+            return self.send(400, {'error': str(e)})
+        if job is None:
+            return self.send(503, {'error': 'queue full, retry later'})
+        config, future = job
+        try:
+            image = future.result()
+        except Exception as e:
+            server.finish(True, time.perf_counter() - start)
+            return self.send(500, {'error': f'{type(e).__name__}: {e}'})
+        seconds = time.perf_counter() - start
+        server.finish(False, seconds)
+        print(f'serve: {len(body)} bytes rendered in {seconds:.2f}s')
+        if image is None:
+            return self.send(200, {'output': config.output, 'seconds': seconds})
+        self.send(200, image, CONTENT_TYPES.get(config.output.rsplit('.', 1)[-1], 'application/octet-stream'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(config, pipeline):
+    """Render server: keeps the interpreter, the imports and the Mitsuba variant warm between renders.
+
+    --address is host:port for HTTP on localhost, or the path of a Unix socket. Each request runs
+    pipeline(config, pcl) (standardize_bbox, color_map, render) in one of --jobs worker processes.
+    """
+    render_server = Server(config, pipeline)
+    if ':' in config.address:
+        host, port = config.address.rsplit(':', 1)
+        httpd = ThreadingHTTPServer((host, int(port)), Handler)
+    else:
+        if os.path.exists(config.address):
+            os.remove(config.address)
+        httpd = UnixHTTPServer(config.address, Handler)
+    httpd.render_server = render_server
+    # stop on SIGTERM as on Ctrl-C, so the workers and the socket file are cleaned up
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f'serving on {config.address} with {max(1, config.jobs)} workers, {config.queue} queued requests')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        render_server.executor.shutdown(cancel_futures=True)
+        if httpd.address_family == socket.AF_UNIX:
+            os.remove(config.address)
+    print(f'serve: {render_server.status()}')
@@ -1,120 +1,182 @@
-import numpy as np
-import cv2
-import sys
-from plyfile import PlyData,PlyElement
-
-def write_ply(save_path, points, text=True):
-    """
-    save_path : path to save: '/yy/XX.ply'
-    pt: point_cloud: size (N,3)
-    """
-    points = [(points[i,0], points[i,1], points[i,2]) for i in range(points.shape[0])]
-    vertex = np.array(points, dtype=[('x', 'f4'), ('y', 'f4'),('z', 'f4')])
-    el = PlyElement.describe(vertex, 'vertex', comments=['vertices'])
-    PlyData([el], text=text).write(save_path)
-
-showsz=800
-mousex,mousey=0.5,0.5
-zoom=1.0
-changed=True
-def onmouse(*args):
-	global mousex,mousey,changed
-	y=args[1]
-	x=args[2]
-	mousex=x/float(showsz) * 2
-	mousey=y/float(showsz) * 2
-	changed=True
-# cv2.namedWindow("show3d", cv2.WINDOW_NORMAL)
-# cv2.moveWindow('show3d',0,0)
-# cv2.setMouseCallback('show3d',onmouse)
-def showpoints(xyz, config, c0=None,c1=None,c2=None,waittime=0,showrot=False,magnifyBlue=0,freezerot=False,background=(0,0,0),normalizecolor=True):
-	global showsz,mousex,mousey,zoom,changed
-	xyz=xyz-xyz.mean(axis=0)
-	radius=((xyz**2).sum(axis=-1)**0.5).max()
-	xyz/=(radius*2.2)/showsz
-	if c0 is None:
-		c0=np.zeros((len(xyz),),dtype='float32')+255
-	if c1 is None:
-		c1=c0
-	if c2 is None:
-		c2=c0
-	if normalizecolor:
-		c0/=(c0.max()+1e-14)/255.0
-		c1/=(c1.max()+1e-14)/255.0
-		c2/=(c2.max()+1e-14)/255.0
-
-	show=np.zeros((showsz,showsz,3),dtype='uint8')
-	def render():
-		rotmat=np.eye(3)
-		if not freezerot:
-			xangle=(mousey-0.5)*np.pi*1.2
-		else:
-			xangle=0
-		rotmat=rotmat.dot(np.array([
-			[1.0,0.0,0.0],
-			[0.0,np.cos(xangle),-np.sin(xangle)],
-			[0.0,np.sin(xangle),np.cos(xangle)],
-			]))
-		if not freezerot:
-			yangle=(mousex-0.5)*np.pi*1.2
-		else:
-			yangle=0
-		rotmat=rotmat.dot(np.array([
-			[np.cos(yangle),0.0,-np.sin(yangle)],
-			[0.0,1.0,0.0],
-			[np.sin(yangle),0.0,np.cos(yangle)],
-			]))
-		rotmat*=zoom
-		nxyz=xyz.dot(rotmat)
-		result = nxyz.copy()
-		nz=nxyz[:,1].argsort()
-		nxyz=nxyz[nz]
-		nxyz=(nxyz[:,:2]+[showsz/2,showsz/2]).astype('int32')
-		p=nxyz[:,0]*showsz+nxyz[:,1]
-		show[:]=background
-		m=(nxyz[:,0]>=0)*(nxyz[:,0]<showsz)*(nxyz[:,1]>=0)*(nxyz[:,1]<showsz)
-		show.reshape((showsz*showsz,3))[p[m],1]=c0[nz][m]
-		show.reshape((showsz*showsz,3))[p[m],2]=c1[nz][m]
-		show.reshape((showsz*showsz,3))[p[m],0]=c2[nz][m]
-		if magnifyBlue>0:
-			show[:,:,0]=np.maximum(show[:,:,0],np.roll(show[:,:,0],1,axis=0))
-			if magnifyBlue>=2:
-				show[:,:,0]=np.maximum(show[:,:,0],np.roll(show[:,:,0],-1,axis=0))
-			show[:,:,0]=np.maximum(show[:,:,0],np.roll(show[:,:,0],1,axis=1))
-			if magnifyBlue>=2:
-				show[:,:,0]=np.maximum(show[:,:,0],np.roll(show[:,:,0],-1,axis=1))
-		if showrot:
-			cv2.putText(show,'xangle %d'%(int(xangle/np.pi*180)),(30,showsz-30),0,0.5,cv2.cv.CV_RGB(255,0,0))
-			cv2.putText(show,'yangle %d'%(int(yangle/np.pi*180)),(30,showsz-50),0,0.5,cv2.cv.CV_RGB(255,0,0))
-			cv2.putText(show,'zoom %d%%'%(int(zoom*100)),(30,showsz-70),0,0.5,cv2.cv.CV_RGB(255,0,0))
-		return result
-	changed=True
-	while True:
-		if changed:
-			result = render()
-			changed=False
-		# cv2.imshow('show3d',show)
-		if waittime==0:
-			cmd=cv2.waitKey(10)%256
-		else:
-			cmd=cv2.waitKey(waittime)%256
-		if cmd==ord('q'):
-			break
-		elif cmd==ord('Q'):
-			sys.exit(0)
-		if cmd==ord('n'):
-			zoom*=1.1
-			changed=True
-		elif cmd==ord('m'):
-			zoom/=1.1
-			changed=True
-		elif cmd==ord('r'):
-			zoom=1.0
-			changed=True
-		elif cmd==ord('s'):
-			cv2.imwrite(config.output, show)
-		elif cmd==ord('p'):
-			write_ply(config.output.split(".")[0] + ".ply", result)
-		if waittime!=0:
-			break
-	return cmd
+import numpy as np
+import cv2
+import sys
+
+def write_ply(save_path, points, text=True):
+    """
+    save_path : path to save: '/yy/XX.ply'
+    pt: point_cloud: size (N,3)
+    """
+    from plyfile import PlyData,PlyElement
+    points = [(points[i,0], points[i,1], points[i,2]) for i in range(points.shape[0])]
+    vertex = np.array(points, dtype=[('x', 'f4'), ('y', 'f4'),('z', 'f4')])
+    el = PlyElement.describe(vertex, 'vertex', comments=['vertices'])
+    PlyData([el], text=text).write(save_path)
+
+def view_rotation(xangle, yangle):
+	# rotation used by showpoints: about x first, then about y
+	rotmat=np.array([
+		[1.0,0.0,0.0],
+		[0.0,np.cos(xangle),-np.sin(xangle)],
+		[0.0,np.sin(xangle),np.cos(xangle)],
+		])
+	return rotmat.dot(np.array([
+		[np.cos(yangle),0.0,-np.sin(yangle)],
+		[0.0,1.0,0.0],
+		[np.sin(yangle),0.0,np.cos(yangle)],
+		]))
+
+def fit_points(xyz, size):
+	# center the points and scale them to fill a size x size image
+	xyz=xyz-xyz.mean(axis=0)
+	radius=((xyz**2).sum(axis=-1)**0.5).max()
+	return xyz/((radius*2.2)/size)
+
+RASTER_CHUNK=1<<14  # point x view pairs rasterized together, small enough for the arrays to stay in cache
+
+def rasterize_chunk(xyz, packed, rotmat, size, point_size):
+	# V x size x size uint32 images of packed colors, plus one extra pixel at the end that catches the points
+	# outside the image; packed[-1] is the background
+	views=rotmat.shape[0]
+	nxyz=np.matmul(xyz,rotmat)
+	px=np.floor(nxyz[...,0]+size/2).astype(np.int32)
+	py=np.floor(nxyz[...,1]+size/2).astype(np.int32)
+	# painter's order: every view's points sorted by depth, so the nearest point of a pixel is written last.
+	# sorting the points once, before the point_size x point_size squares are expanded, is much cheaper than
+	# a z-buffer scatter (np.maximum.at) over every covered pixel
+	point=np.argsort(nxyz[...,2],axis=1)
+	px=np.take_along_axis(px,point,axis=1)
+	py=np.take_along_axis(py,point,axis=1)
+	if point_size>1:
+		ox,oy=np.meshgrid(np.arange(point_size),np.arange(point_size),indexing='ij')
+		px=(px[...,None]+ox.ravel()-(point_size-1)//2).reshape(views,-1)
+		py=(py[...,None]+oy.ravel()-(point_size-1)//2).reshape(views,-1)
+		point=np.repeat(point,point_size*point_size,axis=1)
+
+	inside=(px>=0)&(px<size)&(py>=0)&(py<size)
+	flat=np.where(inside,(np.arange(views)[:,None]*size+px)*size+py,views*size*size)
+	image=np.full(views*size*size+1,packed[-1],dtype=np.uint32)
+	# with repeated indices the last assignment wins, which is the nearest point
+	image[flat.ravel()]=packed.take(point.ravel())
+	return image
+
+def rasterize(xyz, colors=None, rotmat=None, zoom=1.0, size=800, point_size=1, background=(0,0,0), fit=True):
+	"""Headless depth sorted point rasterizer, returns a size x size x 3 uint8 image.
+
+	xyz: N x 3 points, centered and scaled to the image when fit is set.
+	colors: N x 3 uint8, or floats in [0, 1], written to the image channels as given
+	(pass BGR for cv2.imwrite); white when None.
+	rotmat: 3 x 3 rotation, or V x 3 x 3 to render V views at once into a V x size x size x 3 array.
+	point_size: points are drawn as point_size x point_size squares.
+	"""
+	if fit:
+		xyz=fit_points(xyz,size)
+	if colors is None:
+		colors=np.full((len(xyz),3),255,dtype=np.uint8)
+	elif colors.dtype!=np.uint8:
+		colors=(np.clip(colors,0,1)*255).astype(np.uint8)
+	rotmat=np.eye(3) if rotmat is None else np.asarray(rotmat)
+	single=rotmat.ndim==2
+	rotmat=rotmat.reshape(-1,3,3)*zoom
+	views=rotmat.shape[0]
+
+	# colors packed into one uint32 per point, a scalar scatter is several times faster than one of rows
+	packed=np.zeros((len(colors)+1,4),dtype=np.uint8)
+	packed[:-1,:3]=colors
+	packed[-1,:3]=background
+	packed=packed.view(np.uint32).ravel()
+	image=np.empty((views*size,size,3),dtype=np.uint8)
+	chunk=max(1,RASTER_CHUNK//max(1,len(xyz)*point_size*point_size))
+	for first in range(0,views,chunk):
+		last=min(first+chunk,views)
+		packed_image=rasterize_chunk(xyz,packed,rotmat[first:last],size,point_size)
+		# drops the padding byte, much faster than a numpy copy of the strided channels
+		cv2.cvtColor(packed_image[:-1].view(np.uint8).reshape(-1,size,4),cv2.COLOR_BGRA2BGR,
+			dst=image[first*size:last*size])
+	image=image.reshape(views,size,size,3)
+	return image[0] if single else image
+
+showsz=800
+mousex,mousey=0.5,0.5
+zoom=1.0
+changed=True
+def onmouse(*args):
+	global mousex,mousey,changed
+	y=args[1]
+	x=args[2]
+	mousex=x/float(showsz) * 2
+	mousey=y/float(showsz) * 2
+	changed=True
+# cv2.namedWindow("show3d", cv2.WINDOW_NORMAL)
+# cv2.moveWindow('show3d',0,0)
+# cv2.setMouseCallback('show3d',onmouse)
+def showpoints(xyz, config, c0=None,c1=None,c2=None,waittime=0,showrot=False,magnifyBlue=0,freezerot=False,background=(0,0,0),normalizecolor=True):
+	global showsz,mousex,mousey,zoom,changed
+	xyz=fit_points(xyz,showsz)
+	if c0 is None:
+		c0=np.zeros((len(xyz),),dtype='float32')+255
+	if c1 is None:
+		c1=c0
+	if c2 is None:
+		c2=c0
+	if normalizecolor:
+		c0/=(c0.max()+1e-14)/255.0
+		c1/=(c1.max()+1e-14)/255.0
+		c2/=(c2.max()+1e-14)/255.0
+
+	show=np.zeros((showsz,showsz,3),dtype='uint8')
+	def render():
+		if not freezerot:
+			xangle=(mousey-0.5)*np.pi*1.2
+		else:
+			xangle=0
+		if not freezerot:
+			yangle=(mousex-0.5)*np.pi*1.2
+		else:
+			yangle=0
+		rotmat=view_rotation(xangle,yangle)*zoom
+		result=xyz.dot(rotmat)
+		colors=np.stack((c2,c0,c1),axis=1).astype('uint8')
+		show[:]=rasterize(xyz,colors,rotmat,size=showsz,background=background,fit=False)
+		if magnifyBlue>0:
+			show[:,:,0]=np.maximum(show[:,:,0],np.roll(show[:,:,0],1,axis=0))
+			if magnifyBlue>=2:
+				show[:,:,0]=np.maximum(show[:,:,0],np.roll(show[:,:,0],-1,axis=0))
+			show[:,:,0]=np.maximum(show[:,:,0],np.roll(show[:,:,0],1,axis=1))
+			if magnifyBlue>=2:
+				show[:,:,0]=np.maximum(show[:,:,0],np.roll(show[:,:,0],-1,axis=1))
+		if showrot:
+			cv2.putText(show,'xangle %d'%(int(xangle/np.pi*180)),(30,showsz-30),0,0.5,cv2.cv.CV_RGB(255,0,0))
+			cv2.putText(show,'yangle %d'%(int(yangle/np.pi*180)),(30,showsz-50),0,0.5,cv2.cv.CV_RGB(255,0,0))
+			cv2.putText(show,'zoom %d%%'%(int(zoom*100)),(30,showsz-70),0,0.5,cv2.cv.CV_RGB(255,0,0))
+		return result
+	changed=True
+	while True:
+		if changed:
+			result = render()
+			changed=False
+		# cv2.imshow('show3d',show)
+		if waittime==0:
+			cmd=cv2.waitKey(10)%256
+		else:
+			cmd=cv2.waitKey(waittime)%256
+		if cmd==ord('q'):
+			break
+		elif cmd==ord('Q'):
+			sys.exit(0)
+		if cmd==ord('n'):
+			zoom*=1.1
+			changed=True
+		elif cmd==ord('m'):
+			zoom/=1.1
+			changed=True
+		elif cmd==ord('r'):
+			zoom=1.0
+			changed=True
+		elif cmd==ord('s'):
+			cv2.imwrite(config.output, show)
+		elif cmd==ord('p'):
+			write_ply(config.output.split(".")[0] + ".ply", result)
+		if waittime!=0:
+			break
+	return cmd
@@ -1,33 +1,31 @@
-import cv2
+import heapq
+import struct
+import zipfile
 import numpy as np
-from plyfile import PlyData
-from scipy.spatial import distance
-from scipy.ndimage import median_filter, uniform_filter
-from skimage.measure import marching_cubes
+from pointcloud import PointCloud, to_float32
 
+# cv2, mitsuba, plyfile, scipy and skimage are imported by the functions that use them, so loading a .npy file
+# and the stages that need none of them do not pay for the imports at startup
 
-def load(path, separator=','):
+
+def load(path, separator=',', batch=False):
+    # returns a PointCloud, the file data is converted column by column without a full-size intermediate copy.
+    # with batch, a list of PointClouds: every element of a B x N x C file, or the single cloud of other files
     extension = path.split('.')[-1]
+    if extension == 'ply':
+        pcl = ply_to_pointcloud(read_ply_vertex(path))
+        print(f'point cloud shape: {(len(pcl), pcl.channels)}')
+        return [pcl] if batch else pcl
     if extension == 'npy':
-        pcl = np.load(path, allow_pickle=True)
+        try:
+            # memory-mapped, so only the selected batch element is read from disk
+            pcl = np.load(path, mmap_mode='r')
+        except ValueError:
+            pcl = np.load(path, allow_pickle=True)
     elif extension == 'npz':
-        pcl = np.load(path)
-        pcl = pcl['pred']
-    elif extension == 'ply':
-        ply = PlyData.read(path)
-        vertex = ply['vertex']
-        (x, y, z) = (vertex[t] for t in ('x', 'y', 'z'))
-        pcl = np.column_stack((x, y, z))
+        pcl = load_npz(path, 'pred')
     elif extension == 'txt':
-        f = open(path, 'r')
-        line = f.readline()
-        data = []
-        while line:
-            x, y, z = line.split(separator)[:3]
-            data.append([float(x), float(y), float(z)])
-            line = f.readline()
-        f.close()
-        pcl = np.array(data)
+        pcl = load_txt(path, separator)
     elif extension == 'pth':
         import torch
         pcl = torch.load(path, map_location='cpu')
@@ -37,57 +35,159 @@ def load(path, separator=','):
         raise FileNotFoundError
 
     print(f'point cloud shape: {pcl.shape}')
-    assert pcl.shape[-1] == 3 or pcl.shape[-1] == 6
+    assert pcl.shape[-1] in (3, 4, 6)
 
     if len(pcl.shape) == 3:
+        if batch:
+            print(f"the dimension is 3, we keep all {pcl.shape[0]} elements of the batch.")
+            return [PointCloud.from_array(element) for element in pcl]
         pcl = pcl[0]
         print("the dimension is 3, we select the first element in the batch.")
-    return pcl
+    # only the selected element of a memory-mapped batch is read
+    pcl = PointCloud.from_array(pcl)
+    return [pcl] if batch else pcl
+
+
+def load_txt(path, separator=','):
+    # keeps xyz and rgb (6 or more columns), xyz and a value (4 or 5 columns) or xyz, counted on the first
+    # data line; np.loadtxt raises a ValueError when a later line has fewer columns
+    with open(path, 'r') as f:
+        line = next((line for line in f if line.strip() and not line.lstrip().startswith('#')), '')
+    # a trailing separator (1,2,3,) does not start another column
+    columns = len(line.strip().rstrip(separator).split(separator))
+    usecols = range(6) if columns >= 6 else range(4) if columns >= 4 else range(3)
+    return np.loadtxt(path, delimiter=separator, usecols=usecols, ndmin=2)
+
+
+PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1', 'short': 'i2', 'int16': 'i2',
+             'ushort': 'u2', 'uint16': 'u2', 'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+             'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+PLY_COLORS = (('red', 'green', 'blue'), ('r', 'g', 'b'), ('diffuse_red', 'diffuse_green', 'diffuse_blue'))
+
+
+def read_ply_vertex(path):
+    """Vertex element of a ply file as a structured array.
+
+    Binary files whose first element is a list-free vertex block are memory-mapped,
+    so every property column is a view into the file. Anything else goes through plyfile.
+    """
+    with open(path, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError(f'{path} is not a ply file')
+        file_format, elements = None, []
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f'{path} has no end_header')
+            words = line.decode('ascii', errors='replace').split()
+            if not words:
+                continue
+            if words[0] == 'format':
+                file_format = words[1]
+            elif words[0] == 'element':
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == 'property' and elements:
+                elements[-1][2].append(words[1:])
+            elif words[0] == 'end_header':
+                break
+        offset = f.tell()
+
+    endian = {'binary_little_endian': '<', 'binary_big_endian': '>'}.get(file_format)
+    if endian is not None and elements and elements[0][0] == 'vertex' and \
+            all(len(p) == 2 and p[0] in PLY_TYPES for p in elements[0][2]):
+        _, count, properties = elements[0]
+        dtype = np.dtype([(name, endian + PLY_TYPES[t]) for t, name in properties])
+        return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+    from plyfile import PlyData
+    return PlyData.read(path)['vertex'].data
+
+
+def ply_columns(vertex, names):
+    # N x len(names) view of consecutive same-typed properties, no data is copied
+    dtype, offset = vertex.dtype.fields[names[0]][:2]
+    if all(vertex.dtype.fields[n][:2] == (dtype, offset + i * dtype.itemsize) for i, n in enumerate(names)):
+        return np.ndarray((vertex.shape[0], len(names)), dtype=dtype, buffer=vertex, offset=offset,
+                          strides=(vertex.strides[0], dtype.itemsize))
+    return np.stack([vertex[n] for n in names], axis=1)
+
+
+def ply_to_pointcloud(vertex):
+    # uint8 colors are kept as they are, other integer colors are normalized to [0, 1]
+    names = vertex.dtype.names
+    color = next((c for c in PLY_COLORS if all(n in names for n in c)), None)
+    xyz = to_float32(ply_columns(vertex, ('x', 'y', 'z')))
+    if color is None:
+        return PointCloud(xyz)
+    rgb = ply_columns(vertex, color)
+    if rgb.dtype == np.uint8:
+        return PointCloud(xyz, np.array(rgb))
+    if rgb.dtype.kind in 'ui':
+        return PointCloud(xyz, (rgb * np.float32(1.0 / np.iinfo(rgb.dtype).max)).astype(np.float16))
+    return PointCloud(xyz, rgb.astype(np.float16))
+
+
+def load_npz(path, key):
+    # uncompressed members are memory-mapped in place, compressed ones are read in full
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(key + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return np.load(path)[key]
+    with open(path, 'rb') as f:
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        if dtype.hasobject:
+            return np.load(path, allow_pickle=True)[key]
+        offset = f.tell()
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
 
 
 def color_map(config, pcl):
-    n, c = pcl.shape
+    # sets the rgb color buffer of the PointCloud pcl and returns it
+    n, c = len(pcl), pcl.channels
     if config.white:
         print("render with white color.")
-        color = np.ones((n, 3)) * 0.6
+        pcl.color = np.full((n, 3), 0.6, dtype=np.float16)
     elif len(config.RGB) == 3:
         print("render with input RGB color.")
         rgb = np.array(list(map(float, config.RGB))) / 255
-        color = np.tile(rgb, (n, 1))
+        pcl.color = np.tile(rgb.astype(np.float16), (n, 1))
     elif c == 6:
         print("render with points color.")
-        color = pcl[:, 3:]
     elif c == 4:
         print("render with 1-d value color.")
-        color = load_self_colormap(pcl[:, 3])
+        pcl.color = load_self_colormap(pcl.color[:, 0]).astype(np.float16)
     elif config.knn:
         print("render with knn color.")
-        color = np.zeros((n, 3))
-        knn_center = fps(pcl + 0.5, config.center_num)
-        for i in range(n):
-            color[i] = generate_knn_pos_colormap(pcl[i] + 0.5, config, knn_center)
+        knn_center = fps(pcl.xyz + 0.5, config.center_num, config.fps_subset)
+        pcl.color = generate_knn_pos_colormap(pcl.xyz + 0.5, config, knn_center).astype(np.float16)
     else:
         print("render with position color.")
-        color = np.zeros((n, 3))
-        for i in range(n):
-            color[i] = generate_pos_colormap(pcl[i] + 0.5, config)
-
-    return np.concatenate((pcl[:, :3], color), axis=1)
+        pcl.color = generate_pos_colormap(pcl.xyz + 0.5, config).astype(np.float16)
+    return pcl
 
 
-def mask_point(pcl, mask_center=128, mask_ratio=0.5):
-    mask_center = fps(pcl[:, :3], mask_center)
-    mask_center = mask_center[:int(mask_center * mask_ratio)]
-    new_pcl = []
-    for i in range(pcl.shape[0]):
-        distances = distance.cdist(pcl[i, :3], mask_center, 'euclidean')
-        if np.min(distances) > 0.05:
-            new_pcl.append(pcl[i])
-    new_pcl = np.array(new_pcl)
-    return new_pcl
+def mask_point(pcl, mask_center=128, mask_ratio=0.5, mask_radius=0.05, fps_subset=None):
+    # drop every point within mask_radius of the first mask_ratio of mask_center FPS centers
+    from scipy.spatial import cKDTree
+    mask_center = fps(pcl[:, :3], mask_center, fps_subset)
+    mask_center = mask_center[:int(len(mask_center) * mask_ratio)]
+    if len(mask_center) == 0:
+        return pcl
+    distances, _ = cKDTree(mask_center[:, :3]).query(pcl[:, :3])
+    print(f'mask {np.sum(distances <= mask_radius)} points around {len(mask_center)} centers')
+    return pcl[distances > mask_radius]
 
 
 def load_self_colormap(value):
+    import cv2
     vec = np.power(value, 2)  # You can adjust the Level Curve with gamma transformation
     vec = 255 - 255 * (vec - np.min(vec)) / (np.max(vec) - np.min(vec))  # normalize to [0, 255]
     vec = vec.reshape(1, -1).astype(np.uint8)
@@ -98,118 +198,302 @@ def load_self_colormap(value):
 
 
 def generate_pos_colormap(pos, config):
+    # pos is a single point (3,) or a batch of points (N, 3)
     vec = np.clip(pos, config.contrast, 1.0)
-    norm = np.sqrt(np.sum(vec ** 2))
+    norm = np.sqrt(np.sum(vec ** 2, axis=-1, keepdims=True))
     vec /= norm
     return vec
 
 
 def generate_knn_pos_colormap(pos, config, knn_center):
-    dis = np.linalg.norm(knn_center - pos, axis=1)
-    index = np.argmin(dis)
-    vec = knn_center[index]
+    # color every point in pos by the position of its nearest knn center
+    from scipy.spatial import cKDTree
+    _, index = cKDTree(knn_center[:, :3]).query(pos[..., :3])
+    vec = knn_center[index, :3]
+    return generate_pos_colormap(vec, config)
 
-    vec = np.clip(vec, config.contrast, 1.0)
-    norm = np.sqrt(np.sum(vec ** 2))
-    vec /= norm
-    return vec
 
+def standardize_bbox(config, pcl):
+    # normalizes the PointCloud pcl in place, the median filter and the downsampling return a new one
+    if config.median:
+        pcl = PointCloud.from_array(median_filter_3d(pcl.array(), channel=pcl.channels, voxel_size=config.voxel_size))
 
-def standardize_bbox(config, data):
-    pcl = data[:, :3]
-    C = data.shape[1]
+    pcl.xyz = normalize_bbox(pcl.xyz, inplace=True)
+
+    if pcl.channels == 6 and pcl.color.dtype != np.uint8:
+        np.clip(pcl.color, 0, 1, out=pcl.color)
+
+    if config.num < len(pcl):
+        pcl = downsample(pcl, config.num, config.sampler, config.fps_subset)
+        print(f'downsample to {len(pcl)} points with the {config.sampler} sampler')
+
+    return pcl
 
-    if config.median:
-        pcl = median_filter_3d(pcl)
 
+def downsample(pcl, num, sampler="random", fps_subset=None):
+    """Reduce the normalized PointCloud pcl to num points.
+
+    random: uniform random subset. voxel: average of the points of every occupied grid cell, at most num.
+    poisson: blue-noise subset by weighted sample elimination. fps: farthest point sampling.
+    """
+    assert sampler in ("random", "voxel", "poisson", "fps")
+    if sampler == "voxel":
+        return PointCloud.from_array(voxel_grid_sample(pcl.array(), num))
+    if sampler == "poisson":
+        return PointCloud.from_array(poisson_disk_sample(pcl.array(), num))
+    if sampler == "fps":
+        return PointCloud.from_array(fps(pcl.array(), num, fps_subset))
+    # np.random.choice without replacement already returns the indices in random order
+    return pcl.take(np.random.choice(len(pcl), num, replace=False))
+
+
+def voxel_grid_sample(pcl, num, iterations=12):
+    # the occupied cell count of an R^3 grid grows roughly like R^2 on surfaces, which drives the search for
+    # the finest R with at most num occupied cells, each np.unique pass is O(N log N)
+    xyz = np.clip(pcl[:, :3] + 0.5, 0, 1)
+
+    def cells(R):
+        index = np.minimum((xyz * R).astype(np.int64), R - 1)
+        return np.unique(voxel_key(index, R), return_inverse=True)[1].reshape(-1)
+
+    lo, hi, best = 1, None, None
+    R = max(2, int(np.sqrt(num)))
+    for _ in range(iterations):
+        inverse = cells(R)
+        count = inverse.max() + 1
+        if count <= num:
+            lo, best = R, inverse
+            if count >= 0.95 * num:
+                break
+        else:
+            hi = R
+        guess = int(R * np.sqrt(num / count))
+        if hi is None:
+            R = max(guess, R + 1)
+        elif hi - lo <= 1:
+            break
+        else:
+            R = min(max(guess, lo + 1), hi - 1)
+    if best is None:
+        best = cells(lo)
+
+    counts = np.bincount(best)
+    columns = [np.bincount(best, weights=pcl[:, c]) / counts for c in range(pcl.shape[1])]
+    return np.stack(columns, axis=1).astype(pcl.dtype)
+
+
+def poisson_disk_sample(pcl, num, oversample=4):
+    """Blue-noise subset of num points by weighted sample elimination (Yuksel 2015).
+
+    Up to oversample * num random candidates are taken, then the candidate with the most close neighbors
+    is removed until num remain, so the kept points are evenly spread without clumps or holes.
+    """
+    from scipy.spatial import cKDTree
+    if pcl.shape[0] > oversample * num:
+        pcl = pcl[np.random.choice(pcl.shape[0], oversample * num, replace=False)]
+    M = pcl.shape[0]
+    tree = cKDTree(pcl[:, :3])
+
+    # expected spacing of the kept points: the radius around a candidate holding M / num candidates
+    k = int(np.ceil(M / num))
+    distance, _ = tree.query(pcl[:, :3], k=k + 1)
+    r_max = max(float(np.median(distance[:, -1])), 1e-12)
+
+    pairs = tree.query_pairs(2 * r_max, output_type='ndarray')
+    d = np.linalg.norm(pcl[pairs[:, 0], :3] - pcl[pairs[:, 1], :3], axis=1)
+    w = (1 - d / (2 * r_max)) ** 8
+    rows = np.concatenate((pairs[:, 0], pairs[:, 1]))
+    order = np.argsort(rows, kind='stable')
+    neighbors = np.concatenate((pairs[:, 1], pairs[:, 0]))[order]
+    neighbor_weights = np.concatenate((w, w))[order]
+    start = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=M))))
+    weight = np.bincount(rows, weights=np.concatenate((w, w)), minlength=M)
+
+    # plain python lists, the elimination loop is sequential and numpy scalar indexing would dominate it
+    neighbors, neighbor_weights, start = neighbors.tolist(), neighbor_weights.tolist(), start.tolist()
+    weight = weight.tolist()
+    heap = list(zip([-w_i for w_i in weight], range(M)))
+    heapq.heapify(heap)
+    removed = [False] * M
+    left = M
+    while left > num:
+        w_i, i = heapq.heappop(heap)
+        if removed[i]:
+            continue
+        if -w_i != weight[i]:
+            # weights only decrease, so a stale entry is pushed back with its current weight when it surfaces
+            heapq.heappush(heap, (-weight[i], i))
+            continue
+        removed[i] = True
+        left -= 1
+        for n in range(start[i], start[i + 1]):
+            weight[neighbors[n]] -= neighbor_weights[n]
+    return pcl[~np.array(removed)]
+
+
+def normalize_bbox(pcl, inplace=False):
+    # with inplace, a float32 pcl is overwritten instead of copied
     mins = np.amin(pcl, axis=0)
     maxs = np.amax(pcl, axis=0)
     center = (mins + maxs) / 2.
     scale = np.amax(maxs - mins)
-    pcl = ((pcl - center) / scale).astype(np.float32)  # [-0.5, 0.5]
+    if inplace and pcl.dtype == np.float32 and pcl.flags.writeable:
+        pcl -= center
+        pcl /= scale
+    else:
+        pcl = ((pcl - center) / scale).astype(np.float32)  # [-0.5, 0.5]
     print("Center: {}, Scale: {}".format(center, scale))
-
-    if C == 6:
-        color = data[:, 3:]
-        color[color < 0] = 0
-        color[color > 1] = 1
-        pcl = np.concatenate((pcl, color), axis=1)
-
-    if config.num < pcl.shape[0]:
-        print(f'downsample to {config.num} points')
-        pt_indices = np.random.choice(pcl.shape[0], config.num, replace=False)
-        np.random.shuffle(pt_indices)
-        pcl = pcl[pt_indices]
-
     return pcl
 
 
-def fps(data, k):
+def fps(data, k, subset=None):
+    """Farthest point sampling of k rows of data, starting from the point farthest from the barycenter.
+
+    With subset, FPS runs over that many randomly chosen points instead of all of them,
+    which is much faster for large N and k and close enough for color clustering.
+    Every point is sampled at most once: the subset is at least k points, and k is at most N.
+    """
+    if subset and max(subset, k) < data.shape[0]:
+        data = data[np.random.choice(data.shape[0], max(subset, k), replace=False)]
     N, C = data.shape
+    k = min(k, N)
     sample_data = np.zeros((k, C))
-    points = data[:, :3]
-    color = data[:, 3:]
-    barycenter = np.sum(points, axis=0) / points.shape[0]
-    distance = np.full((points.shape[0]), np.nan)
+    dtype = np.result_type(data.dtype, np.float32)
+    x, y, z = np.array(data[:, :3].T, dtype=dtype)
+    barycenter = np.sum(data[:, :3], axis=0) / N
+    distance = np.full(N, np.inf, dtype=dtype)
+    d, tmp = np.empty(N, dtype=dtype), np.empty(N, dtype=dtype)
     point = barycenter
 
     for i in range(k):
-        distance = np.minimum(distance, np.sum((points - point) ** 2, axis=1))
+        np.subtract(x, point[0], out=d)
+        np.multiply(d, d, out=d)
+        np.subtract(y, point[1], out=tmp)
+        np.multiply(tmp, tmp, out=tmp)
+        np.add(d, tmp, out=d)
+        np.subtract(z, point[2], out=tmp)
+        np.multiply(tmp, tmp, out=tmp)
+        np.add(d, tmp, out=d)
+        np.minimum(distance, d, out=distance)
         index = np.argmax(distance)
-        point = points[index]
-        sample_data[i] = np.concatenate((point, color[index]), axis=0)
-        mask = np.ones((points.shape[0]), dtype=bool)
-        mask[index] = False
-        points = points[mask]
-        distance = distance[mask]
+        point = (x[index], y[index], z[index])
+        sample_data[i] = data[index]
+        distance[index] = -1  # visited, never selected again
     return sample_data
 
 
 def median_filter_3d(pcl, channel=3, voxel_size=64, kernel_size=2, level=0.5, times=1):
+    """Denoise a point cloud by voxelizing it, median filtering the occupancy and extracting the surface.
+
+    The occupancy grid is kept sparse (only occupied voxel indices), so memory and runtime scale with
+    the occupied voxels instead of voxel_size ** 3. For channel == 6 the surface points take the color
+    of their nearest input point.
+    """
+    from scipy.spatial import cKDTree
     print("using median filter")
     for i in range(times):
-        voxel = point_cloud_to_voxel(pcl, voxel_size=voxel_size)
-        voxel = median_filter(voxel, size=kernel_size)
-        median_pcl = voxel_to_point_cloud(voxel, level=level)
-        N = median_pcl.shape[0]
-        new_pcl = np.zeros((N, channel))
+        index, min_bound, max_bound = point_cloud_to_voxel_index(pcl[:, :3], voxel_size)
+        index = sparse_median_filter(index, voxel_size, kernel_size)
+        median_pcl = sparse_voxel_to_point_cloud(index, voxel_size, level)
+        median_pcl = median_pcl / (voxel_size - 1) * max_bound + min_bound  # back to the input coordinates
         if channel == 6:
-            for i in range(N):
-                distances = distance.cdist(median_pcl[i, :3], pcl[:, :3], 'euclidean')
-                index = np.argmin(distances)
-                new_pcl[i, :3] = median_pcl[i, :3]
-                new_pcl[i, 3:] = pcl[index, 3:]
-        else:
-            new_pcl = median_pcl
-        pcl = new_pcl
+            _, nearest = cKDTree(pcl[:, :3]).query(median_pcl)
+            median_pcl = np.concatenate((median_pcl, pcl[nearest, 3:]), axis=1)
+        pcl = median_pcl
     print("filtered point cloud shape: ", pcl.shape)
     return pcl
 
 
-def point_cloud_to_voxel(point_cloud, voxel_size):
+def point_cloud_to_voxel_index(point_cloud, voxel_size):
+    # unique (M, 3) indices of the occupied voxels of an R x R x R grid over the cloud
     R = voxel_size
-    voxel_shape = (R, R, R)
-
-    voxel_data = np.zeros(voxel_shape, dtype=np.int32)
-
     min_bound = np.min(point_cloud, axis=0)
     point_cloud = point_cloud - min_bound
     max_bound = np.max(np.max(point_cloud, axis=0))
 
     point_cloud_scaled = point_cloud / max_bound * (R - 1)
+    keys = np.unique(voxel_key(np.floor(point_cloud_scaled).astype(np.int64), R))
+    return key_to_index(keys, R), min_bound, max_bound
 
-    for point in point_cloud_scaled:
-        voxel_index = np.floor(point).astype(int)
-        voxel_data[voxel_index[0], voxel_index[1], voxel_index[2]] = 1
 
+def point_cloud_to_voxel(point_cloud, voxel_size):
+    R = voxel_size
+    voxel_data = np.zeros((R, R, R), dtype=np.int32)
+    index, _, _ = point_cloud_to_voxel_index(point_cloud, voxel_size)
+    voxel_data[index[:, 0], index[:, 1], index[:, 2]] = 1
     return voxel_data
 
 
+def voxel_key(index, R):
+    return (index[..., 0] * R + index[..., 1]) * R + index[..., 2]
+
+
+def key_to_index(keys, R):
+    return np.stack((keys // (R * R), keys // R % R, keys % R), axis=1)
+
+
+def reflect_index(index, R):
+    # scipy.ndimage 'reflect' boundary mode: -1 -> 0, R -> R - 1
+    index = np.where(index < 0, -index - 1, index)
+    return np.where(index >= R, 2 * R - index - 1, index)
+
+
+def sparse_median_filter(index, R, kernel_size=2):
+    """scipy.ndimage.median_filter(size=kernel_size) of a binary occupancy grid given by its occupied indices.
+
+    On binary data the median is 1 exactly when enough voxels of the (reflected) window are occupied,
+    so only voxels whose window touches an occupied one need to be counted.
+    """
+    offsets = np.stack(np.meshgrid(*[np.arange(kernel_size) - kernel_size // 2] * 3, indexing='ij'), -1).reshape(-1, 3)
+    threshold = kernel_size ** 3 - kernel_size ** 3 // 2
+
+    # every voxel whose window holds an occupied voxel, reflected border indices stay inside the window
+    candidates = np.concatenate([index - offset for offset in offsets])
+    candidates = candidates[np.all((candidates >= 0) & (candidates < R), axis=1)]
+    candidates = key_to_index(np.unique(voxel_key(candidates, R)), R)
+
+    occupied = np.sort(voxel_key(index, R))
+    count = np.zeros(len(candidates), dtype=np.int32)
+    for offset in offsets:
+        keys = voxel_key(reflect_index(candidates + offset, R), R)
+        position = np.minimum(np.searchsorted(occupied, keys), len(occupied) - 1)
+        count += occupied[position] == keys
+    return candidates[count >= threshold]
+
+
 def voxel_to_point_cloud(voxel, level):
+    from skimage.measure import marching_cubes
     pts, _, _, _ = marching_cubes(voxel, level=level)
     return pts
 
 
+def sparse_voxel_to_point_cloud(index, R, level, slab_size=32):
+    # marching cubes slab by slab along x, each slab cropped to its occupied voxels plus a one voxel margin
+    keys = np.sort(voxel_key(index, R))
+    index = key_to_index(keys, R)
+    points = []
+    for start in range(0, R - 1, slab_size):
+        end = min(start + slab_size, R - 1)
+        lo, hi = np.searchsorted(keys, [start * R * R, (end + 1) * R * R])
+        slab = index[lo:hi]
+        if len(slab) == 0:
+            continue
+        mins = np.maximum(slab.min(axis=0) - 1, 0)
+        maxs = np.minimum(slab.max(axis=0) + 1, R - 1)
+        mins[0], maxs[0] = start, end
+        voxel = np.zeros(maxs - mins + 1, dtype=np.float32)
+        voxel[tuple((slab - mins).T)] = 1
+        if not voxel.min() < level < voxel.max():
+            continue
+        pts = voxel_to_point_cloud(voxel, level) + mins
+        if end < R - 1:
+            pts = pts[pts[:, 0] < end]  # the next slab starts on this plane
+        points.append(pts)
+    if not points:
+        return np.zeros((0, 3))
+    return np.concatenate(points)
+
+
 def rotation(rotation_angle):
     x, y, z = rotation_angle
     x, y, z = int(x), int(y), int(z)
@@ -224,33 +508,36 @@ def rotation(rotation_angle):
     return rot_matrix
 
 
-def get_xml(resolution=[1920, 1080], view=[3, 3, 3], radius=0.025, object_type="point"):
+def get_xml(resolution=[1920, 1080], view=[3, 3, 3], radius=0.025, object_type="point", spp=256, views=None):
+    # views: optional list of camera positions, one sensor each, replaces view
     width, height = int(resolution[0]), int(resolution[1])
-    x, y, z = float(view[0]), float(view[1]), float(view[2])
-    position = f"{x}, {y}, {z}"
-    xml_head = \
-        f"""
-    <scene version="0.6.0">
-        <integrator type="path">
-            <integer name="maxDepth" value="-1"/>
-        </integrator>
+    xml_sensor_segment = \
+        """
         <sensor type="perspective">
             <float name="farClip" value="100"/>
             <float name="nearClip" value="0.1"/>
             <transform name="toWorld">
-                <lookat origin="{position}" target="0,0,0" up="0,0,1"/>
+                <lookat origin="{}, {}, {}" target="0,0,0" up="0,0,1"/>
             </transform>
             <float name="fov" value="25"/>
             <sampler type="independent">
-                <integer name="sampleCount" value="256"/>
+                <integer name="sampleCount" value="%d"/>
             </sampler>
             <film type="hdrfilm">
-                <integer name="width" value="{width}"/>
-                <integer name="height" value="{height}"/>
+                <integer name="width" value="%d"/>
+                <integer name="height" value="%d"/>
                 <rfilter type="gaussian"/>
             </film>
         </sensor>
-
+    """ % (int(spp), width, height)
+    xml_sensors = ''.join(xml_sensor_segment.format(*map(float, v)) for v in (views or [view]))
+    xml_head = \
+        f"""
+    <scene version="0.6.0">
+        <integrator type="path">
+            <integer name="maxDepth" value="-1"/>
+        </integrator>
+{xml_sensors}
         <bsdf type="roughplastic" id="surfaceMaterial">
             <string name="distribution" value="ggx"/>
             <float name="alpha" value="0.05"/>
@@ -273,19 +560,6 @@ def get_xml(resolution=[1920, 1080], view=[3, 3, 3], radius=0.025, object_type="
         </shape>
     """ % radius
 
-    xml_cube_segment = \
-        """
-        <shape type="cube">
-        <transform name="toWorld">
-            <scale x="%s" y="%s" z="%s" />
-            <translate x="{}" y="{}" z="{}"/>
-        </transform>
-        <bsdf type="diffuse">
-            <rgb name="reflectance" value="{},{},{}"/>
-        </bsdf>
-    </shape>
-    """ % (radius, radius, radius)
-
     xml_tail = \
         """
         <shape type="rectangle">
@@ -308,6 +582,219 @@ def get_xml(resolution=[1920, 1080], view=[3, 3, 3], radius=0.025, object_type="
     </scene>
     """
 
-    assert object_type == "point" or object_type == "voxel"
-    xml_object_segment = xml_ball_segment if object_type == "point" else xml_cube_segment
+    xml_mesh_segment = \
+        """
+        <shape type="ply">
+            <string name="filename" value="{}"/>
+            <bsdf type="diffuse">
+                <texture type="mesh_attribute" name="reflectance">
+                    <string name="name" value="vertex_color"/>
+                </texture>
+            </bsdf>
+        </shape>
+    """
+
+    assert object_type in ("point", "voxel", "mesh")
+    # voxel and mesh are written as one ply mesh each
+    xml_object_segment = {"point": xml_ball_segment, "voxel": xml_mesh_segment, "mesh": xml_mesh_segment}[object_type]
     return xml_head, xml_object_segment, xml_tail
+
+
+def get_sensor_dict(view, resolution, spp=256, crop=None):
+    # perspective camera at view aimed at the origin. crop = (x, y, width, height) renders only that window
+    # of the film, with the same reconstruction filter
+    import mitsuba as mi
+    x, y, z = view
+    film = {'type': 'hdrfilm', 'width': int(resolution[0]), 'height': int(resolution[1]),
+            'rfilter': {'type': 'gaussian'}}
+    if crop is not None:
+        film.update(crop_offset_x=int(crop[0]), crop_offset_y=int(crop[1]), crop_width=int(crop[2]),
+                    crop_height=int(crop[3]))
+    return {
+        'type': 'perspective',
+        'far_clip': 100.0,
+        'near_clip': 0.1,
+        'to_world': mi.ScalarTransform4f().look_at(origin=[float(x), float(y), float(z)], target=[0, 0, 0],
+                                                   up=[0, 0, 1]),
+        'fov': 25.0,
+        'sampler': {'type': 'independent', 'sample_count': int(spp)},
+        'film': film,
+    }
+
+
+def get_scene_dict(pcl, resolution=[1920, 1080], view=[3, 3, 3], radius=0.025, object_type="point", spp=256,
+                   views=None):
+    """Same scene as get_xml, built as a mitsuba dict for mi.load_dict.
+
+    pcl is an N x 6 array of (x, y, z, r, g, b) already in scene coordinates.
+    With views, the scene gets one sensor per camera position (in that order) instead of view,
+    so several views share the loaded geometry. The mitsuba variant has to be set before calling this.
+    """
+    import mitsuba as mi
+    T = mi.ScalarTransform4f
+    scene = {
+        'type': 'scene',
+        'integrator': {'type': 'path', 'max_depth': -1},
+    }
+    for i, camera in enumerate(views or [view]):
+        scene['sensor' if i == 0 else f'sensor_{i}'] = get_sensor_dict(camera, resolution, spp)
+    scene['surfaceMaterial'] = {
+        'type': 'roughplastic',
+        'distribution': 'ggx',
+        'alpha': 0.05,
+        'int_ior': 1.46,
+        'diffuse_reflectance': {'type': 'rgb', 'value': [1.0, 1.0, 1.0]},
+    }
+
+    assert object_type in ("point", "voxel", "mesh")
+    radius = float(radius)
+    if object_type == "mesh":
+        # one shape and one bsdf for the whole cloud
+        scene['points'] = create_mesh(*get_point_mesh(pcl, radius))
+    elif object_type == "voxel":
+        scene['points'] = create_mesh(*get_voxel_mesh(pcl, radius))
+    else:
+        for i in range(pcl.shape[0]):
+            x, y, z, r, g, b = pcl[i, :6].tolist()
+            bsdf = {'type': 'diffuse', 'reflectance': {'type': 'rgb', 'value': [r, g, b]}}
+            scene[f'point_{i}'] = {'type': 'sphere', 'center': [x, y, z], 'radius': radius, 'bsdf': bsdf}
+
+    scene['floor'] = {
+        'type': 'rectangle',
+        'bsdf': {'type': 'ref', 'id': 'surfaceMaterial'},
+        'to_world': T().translate([0, 0, -0.3]).scale([100, 100, 2]),
+    }
+    scene['light'] = {
+        'type': 'rectangle',
+        'to_world': T().look_at(origin=[-4, 4, 20], target=[0, 0, 0], up=[0, 0, 1]).scale([10, 10, 1]),
+        'emitter': {'type': 'area', 'radiance': {'type': 'rgb', 'value': [6.0, 6.0, 6.0]}},
+    }
+    return scene
+
+
+def get_sphere_template(subdivisions=0):
+    # icosphere: 12 / 42 / 162 vertices for 0 / 1 / 2 subdivisions
+    t = (1.0 + np.sqrt(5.0)) / 2.0
+    vertices = np.array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0],
+                         [0, -1, t], [0, 1, t], [0, -1, -t], [0, 1, -t],
+                         [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]], dtype=np.float64)
+    faces = np.array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11],
+                      [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8],
+                      [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9],
+                      [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]], dtype=np.int64)
+    for _ in range(subdivisions):
+        edges = np.sort(np.concatenate((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]])), axis=1)
+        edges, inverse = np.unique(edges, axis=0, return_inverse=True)
+        midpoints = len(vertices) + inverse.reshape(3, -1).T  # midpoint of edge (01, 12, 20) per face
+        vertices = np.concatenate((vertices, (vertices[edges[:, 0]] + vertices[edges[:, 1]]) / 2))
+        a, b, c = faces.T
+        ab, bc, ca = midpoints.T
+        faces = np.concatenate((np.stack((a, ab, ca), axis=1), np.stack((b, bc, ab), axis=1),
+                                np.stack((c, ca, bc), axis=1), np.stack((ab, bc, ca), axis=1)))
+    vertices /= np.linalg.norm(vertices, axis=1, keepdims=True)
+    return vertices, faces
+
+
+def get_point_mesh(pcl, radius=0.025, subdivisions=0):
+    """Fuse every point of an N x 6 array into one triangle mesh of small spheres.
+
+    Returns vertex positions, faces, vertex normals and vertex colors as flat arrays.
+    """
+    template, template_faces = get_sphere_template(subdivisions)
+    N, V = pcl.shape[0], template.shape[0]
+    vertices = (pcl[:, None, :3] + template[None] * radius).reshape(-1, 3)
+    normals = np.broadcast_to(template, (N, V, 3)).reshape(-1, 3)
+    faces = (template_faces[None] + (np.arange(N) * V)[:, None, None]).reshape(-1, 3)
+    colors = np.repeat(pcl[:, 3:6], V, axis=0)
+    return vertices, faces, normals, colors
+
+
+# corners of the six faces of the [-1, 1] cube, counter-clockwise seen from outside, with the neighbor offset
+# each face is hidden by
+CUBE_FACES = np.array([
+    [[1, -1, -1], [1, 1, -1], [1, 1, 1], [1, -1, 1]],
+    [[-1, -1, -1], [-1, -1, 1], [-1, 1, 1], [-1, 1, -1]],
+    [[-1, 1, -1], [-1, 1, 1], [1, 1, 1], [1, 1, -1]],
+    [[-1, -1, -1], [1, -1, -1], [1, -1, 1], [-1, -1, 1]],
+    [[-1, -1, 1], [1, -1, 1], [1, 1, 1], [-1, 1, 1]],
+    [[-1, -1, -1], [-1, 1, -1], [1, 1, -1], [1, -1, -1]],
+], dtype=np.float64)
+CUBE_NEIGHBORS = np.array([[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0], [0, 0, 1], [0, 0, -1]])
+
+
+def get_voxel_mesh(pcl, radius=0.025):
+    """Quantize an N x 6 array to a grid of 2 * radius cells and build one mesh of the exposed voxel faces.
+
+    Points in the same cell are merged and the cell takes their mean color, faces between two occupied
+    cells are left out. Returns vertex positions, faces, None normals (flat shading) and vertex colors.
+    """
+    # cell keys are accumulated one axis at a time, keeping the temporaries at a single column
+    cell = np.float32(2 * radius)
+    base = np.floor(pcl[:, :3].min(axis=0) / cell + 0.5).astype(np.int64) - 1  # one empty cell of margin
+    R = int(np.max(np.floor(pcl[:, :3].max(axis=0) / cell + 0.5).astype(np.int64) - base)) + 2
+    keys = np.zeros(len(pcl), dtype=np.int64)
+    for axis in range(3):
+        keys *= R
+        keys += np.floor(pcl[:, axis] / cell + 0.5).astype(np.int64) - base[axis]
+    inverse = keys
+    keys = np.unique(keys)
+    inverse = np.searchsorted(keys, inverse)
+    counts = np.bincount(inverse)
+    colors = np.stack([np.bincount(inverse, weights=pcl[:, c]) / counts for c in range(3, 6)], axis=1)
+    cells = key_to_index(keys, R)
+    centers = (cells + base) * (2 * radius)
+
+    vertices, faces, vertex_colors = [], [], []
+    offset = 0
+    for corners, neighbor in zip(CUBE_FACES, CUBE_NEIGHBORS):
+        neighbor_keys = voxel_key(cells + neighbor, R)
+        position = np.minimum(np.searchsorted(keys, neighbor_keys), len(keys) - 1)
+        exposed = keys[position] != neighbor_keys
+        M = int(np.sum(exposed))
+        vertices.append((centers[exposed, None] + corners[None] * radius).reshape(-1, 3))
+        vertex_colors.append(np.repeat(colors[exposed], 4, axis=0))
+        quad = offset + 4 * np.arange(M)[:, None]
+        faces.append(np.concatenate((quad + [0, 1, 2], quad + [0, 2, 3]), axis=1).reshape(-1, 3))
+        offset += 4 * M
+    print(f'voxel mesh: {len(pcl)} points in {len(keys)} voxels, {offset // 4} exposed faces')
+    return np.concatenate(vertices), np.concatenate(faces), None, np.concatenate(vertex_colors)
+
+
+def create_mesh(vertices, faces, normals=None, colors=None, name="points"):
+    # mitsuba mesh whose diffuse reflectance is read from the per-vertex color attribute
+    import mitsuba as mi
+    props = mi.Properties()
+    props['mesh_bsdf'] = mi.load_dict({
+        'type': 'diffuse',
+        'reflectance': {'type': 'mesh_attribute', 'name': 'vertex_color'},
+    })
+    mesh = mi.Mesh(name, vertex_count=len(vertices), face_count=len(faces), props=props,
+                   has_vertex_normals=normals is not None, has_vertex_texcoords=False)
+    mesh.add_attribute('vertex_color', 3, np.zeros(len(vertices) * 3, dtype=np.float32))
+    params = mi.traverse(mesh)
+    params['vertex_positions'] = np.ravel(vertices).astype(np.float32)
+    params['faces'] = np.ravel(faces).astype(np.uint32)
+    if normals is not None:
+        params['vertex_normals'] = np.ravel(normals).astype(np.float32)
+    if colors is not None:
+        params['vertex_color'] = np.ravel(colors).astype(np.float32)
+    params.update()
+    return mesh
+
+
+def write_mesh_ply(path, vertices, faces, normals=None, colors=None):
+    from plyfile import PlyData, PlyElement
+    properties = [('x', 'f4'), ('y', 'f4'), ('z', 'f4')]
+    if normals is not None:
+        properties += [('nx', 'f4'), ('ny', 'f4'), ('nz', 'f4')]
+    if colors is not None:
+        properties += [('r', 'f4'), ('g', 'f4'), ('b', 'f4')]
+    vertex = np.empty(len(vertices), dtype=properties)
+    vertex['x'], vertex['y'], vertex['z'] = vertices.T
+    if normals is not None:
+        vertex['nx'], vertex['ny'], vertex['nz'] = normals.T
+    if colors is not None:
+        vertex['r'], vertex['g'], vertex['b'] = colors.T
+    face = np.empty(len(faces), dtype=[('vertex_indices', 'i4', (3,))])
+    face['vertex_indices'] = faces
+    PlyData([PlyElement.describe(vertex, 'vertex'), PlyElement.describe(face, 'face')]).write(path)